@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+import multiprocessing
+import platform
+import random
+import subprocess
+import threading
+import time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import aiohttp
+from aiohttp import web
+import numpy
+import requests
+import websockets
+
+from orderbook.book import Book
+from orderbook.fixedpoint import price_to_ticks, size_to_units
+from orderbook.manager import BookManager
+from orderbook.pipeline import DecodePipeline
+from orderbook.synthetic import SyntheticFeed
+from orderbook.tree import Tree
+
+ARGS = argparse.ArgumentParser(description='Offline order book benchmarks on a synthetic feed.')
+ARGS.add_argument('--orders', type=int, default=20000, help='Resting orders in the starting snapshot')
+ARGS.add_argument('--messages', type=int, default=200000, help='Feed messages to replay')
+ARGS.add_argument('--levels', type=int, default=500, help='Price levels per side')
+ARGS.add_argument('--spread', type=int, default=1, help='Ticks between best bid and best ask')
+ARGS.add_argument('--cancel-ratio', type=float, default=0.4)
+ARGS.add_argument('--match-ratio', type=float, default=0.1)
+ARGS.add_argument('--change-ratio', type=float, default=0.05)
+ARGS.add_argument('--seed', type=int, default=1)
+ARGS.add_argument('--products', type=int, default=4, help='Products multiplexed through one BookManager')
+ARGS.add_argument('--workers', default='none', help='Comma separated decode pipeline sizes to benchmark, such as 2,4')
+ARGS.add_argument('--snapshot', default=None,
+                  help='Saved level 3 snapshot, such as testdata/beginning_level_3.json, for the tree benchmarks')
+ARGS.add_argument('--latency', type=int, default=0,
+                  help='Also measure websocket message to book applied latency over this many messages of a local '
+                       'feed, with order entry on executor threads and on asyncio')
+ARGS.add_argument('--feed-rate', type=int, default=2000, help='Messages per second sent by the local feed')
+ARGS.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+ARGS.add_argument('--output', default='benchmark_results.json', help='Where to save the results')
+ARGS.add_argument('--compare', default=None, help='Earlier results file to compare against')
+
+
+def best_rate(function, operations, repeat):
+    best = None
+    for _ in range(repeat):
+        seconds = function()
+        if best is None or seconds < best:
+            best = seconds
+    return operations / best
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_tree(snapshot, fixed_point, repeat):
+    parse_price = price_to_ticks if fixed_point else Decimal
+    parse_size = size_to_units if fixed_point else Decimal
+    orders = [(order_id, parse_size(size), parse_price(price))
+              for price, size, order_id in snapshot['bids']]
+    one = parse_size('0.00000001')
+    order_ids = [order_id for order_id, size, price in orders]
+    shuffled = list(order_ids)
+    random.Random(0).shuffle(shuffled)
+
+    def loaded_tree():
+        tree = Tree(is_bid=True)
+        for order_id, size, price in orders:
+            tree.insert_order(order_id, size, price, initial=True)
+        return tree
+
+    def insert():
+        tree = Tree(is_bid=True)
+        start = time.perf_counter()
+        for order_id, size, price in orders:
+            tree.insert_order(order_id, size, price, initial=True)
+        return time.perf_counter() - start
+
+    def bulk_load():
+        return timed(Tree.from_snapshot, [(price, size, order_id) for order_id, size, price in orders], True)
+
+    def match():
+        tree = loaded_tree()
+        return timed(lambda: [tree.match(order_id, one) for order_id in order_ids])
+
+    def change():
+        tree = loaded_tree()
+        return timed(lambda: [tree.change(order_id, one) for order_id in order_ids])
+
+    def remove():
+        tree = loaded_tree()
+        return timed(lambda: [tree.remove_order(order_id) for order_id in shuffled])
+
+    return {name: best_rate(function, len(orders), repeat)
+            for name, function in (('insert_order', insert), ('from_snapshot', bulk_load), ('match', match),
+                                   ('change', change), ('remove_order', remove))}
+
+
+def benchmark_book(beginning_level_3, messages, fixed_point, repeat):
+    def process():
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3(beginning_level_3)
+        process_message = order_book.process_message
+        start = time.perf_counter()
+        for message in messages:
+            process_message(message)
+        return time.perf_counter() - start
+
+    def load():
+        return timed(Book(fixed_point=fixed_point).get_level3, beginning_level_3)
+
+    document = json.dumps(beginning_level_3).encode('utf-8')
+    chunks = [document[start:start + 64 * 1024] for start in range(0, len(document), 64 * 1024)]
+
+    def stream():
+        return timed(Book(fixed_point=fixed_point).stream_level3, chunks)
+
+    orders = len(beginning_level_3['bids']) + len(beginning_level_3['asks'])
+    return {'process_message': best_rate(process, len(messages), repeat),
+            'get_level3_orders': best_rate(load, orders, repeat),
+            'stream_level3_orders': best_rate(stream, orders, repeat)}
+
+
+def product_feeds(args):
+    """Snapshots and the interleaved messages of args.products synthetic products, as one socket delivers them."""
+    snapshots = {}
+    streams = []
+    for number in range(args.products):
+        product_id = 'P{0}-USD'.format(number)
+        feed = SyntheticFeed(orders=args.orders // args.products, levels=args.levels, spread=args.spread,
+                             cancel_ratio=args.cancel_ratio, match_ratio=args.match_ratio,
+                             change_ratio=args.change_ratio, seed=args.seed + number, product_id=product_id)
+        snapshots[product_id] = feed.snapshot()
+        streams.append(list(feed.messages(args.messages // args.products)))
+    order = random.Random(args.seed)
+    positions = [0] * len(streams)
+    messages = []
+    live = list(range(len(streams)))
+    while live:
+        stream = order.choice(live)
+        messages.append(streams[stream][positions[stream]])
+        positions[stream] += 1
+        if positions[stream] == len(streams[stream]):
+            live.remove(stream)
+    return snapshots, messages
+
+
+def benchmark_manager(snapshots, messages, fixed_point, repeat):
+    def process():
+        manager = BookManager(sorted(snapshots), fixed_point=fixed_point)
+        for product_id, snapshot in snapshots.items():
+            manager[product_id].get_level3(snapshot)
+        process_message = manager.process_message
+        start = time.perf_counter()
+        for message in messages:
+            process_message(message)
+        return time.perf_counter() - start
+
+    return {'book_manager_messages': best_rate(process, len(messages), repeat)}
+
+
+def benchmark_pipeline(beginning_level_3, messages, workers, repeat):
+    """Frames per second from raw JSON to applied, inline and through decode pipelines of each size."""
+    frames = [json.dumps(message) for message in messages]
+
+    def inline():
+        order_book = Book(fixed_point=True)
+        order_book.get_level3(beginning_level_3)
+        process_message = order_book.process_message
+        loads = json.loads
+        start = time.perf_counter()
+        for frame in frames:
+            process_message(loads(frame))
+        return time.perf_counter() - start
+
+    def pipelined(pipeline):
+        order_book = Book(fixed_point=True, normalized=True)
+        order_book.get_level3(beginning_level_3)
+        process_message = order_book.process_message
+        submit = pipeline.submit
+        ready = pipeline.ready
+        start = time.perf_counter()
+        for frame in frames:
+            submit(frame)
+            for message in ready():
+                process_message(message)
+        for message in pipeline.drain():
+            process_message(message)
+        return time.perf_counter() - start
+
+    rates = {'decode_inline': best_rate(inline, len(frames), repeat)}
+    for count in workers:
+        pipeline = DecodePipeline(workers=count)
+        try:
+            rates['decode_pipeline_{0}'.format(count)] = best_rate(lambda: pipelined(pipeline), len(frames), repeat)
+        finally:
+            pipeline.close()
+    return rates
+
+
+# order entry stand in: exchange round trip time, and the open orders list get_open_orders receives
+EXCHANGE_DELAY = 0.005
+OPEN_ORDERS = [{'id': str(index), 'price': '6500.00', 'size': '0.01', 'side': 'buy', 'status': 'open',
+                'product_id': 'BTC-USD'} for index in range(100)]
+
+
+def latency_server(feed_parameters, count, rate, ports):
+    """Serve a level 3 snapshot, a websocket feed stamped with its send time and a fake exchange API.
+
+    Runs in its own process, so that sending the feed never competes with the client being measured.
+    perf_counter_ns is the system wide monotonic clock, so the stamps are comparable across processes.
+    """
+    feed = SyntheticFeed(**feed_parameters)
+    snapshot = feed.snapshot()
+
+    async def book(request):
+        return web.json_response(snapshot)
+
+    async def stream(request):
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        burst = max(rate // 100, 1)
+        for index, message in enumerate(feed.messages(count)):
+            message['sent_ns'] = time.perf_counter_ns()
+            await websocket.send_str(json.dumps(message))
+            if index % burst == burst - 1:
+                await asyncio.sleep(burst / rate)
+        await websocket.close()
+        return websocket
+
+    async def orders(request):
+        await request.read()
+        await asyncio.sleep(EXCHANGE_DELAY)
+        if request.method == 'POST':
+            return web.json_response({'id': 'o1', 'status': 'pending'})
+        return web.json_response(OPEN_ORDERS)
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get('/book', book)
+        app.router.add_get('/feed', stream)
+        app.router.add_route('*', '/orders', orders)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        ports.put(site._server.sockets[0].getsockname()[1])
+        await asyncio.sleep(3600)
+
+    asyncio.run(serve())
+
+
+ORDER = {'size': '0.01', 'price': '6500.00', 'side': 'buy', 'product_id': 'BTC-USD', 'post_only': True}
+
+
+def blocking_trader(url, stop):
+    # the order entry loop as it ran before asyncio: blocking requests calls on an executor thread
+    while not stop.is_set():
+        response = requests.post(url + 'orders', json=ORDER)
+        if response.json()['status'] == 'pending':
+            response.json()['id']
+        requests.get(url + 'orders').json()
+        time.sleep(0.005)
+
+
+async def async_trader(url, session, stop):
+    while not stop.is_set():
+        async with session.post(url + 'orders', json=ORDER) as response:
+            json.loads(await response.text())
+        async with session.get(url + 'orders') as response:
+            json.loads(await response.text())
+        await asyncio.sleep(0.005)
+
+
+async def measure_latency(url, order_entry, traders):
+    """Latencies in ns from the feed sending each message to the book having applied it."""
+    order_book = Book()
+    order_book.get_level3(requests.get(url + 'book').json())
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    session = aiohttp.ClientSession()
+    executor = ThreadPoolExecutor(traders)
+    if order_entry == 'executor':
+        tasks = [loop.run_in_executor(executor, blocking_trader, url, stop) for _ in range(traders)]
+    else:
+        tasks = [asyncio.ensure_future(async_trader(url, session, stop)) for _ in range(traders)]
+    latencies = []
+    websocket = await websockets.connect(url.replace('http', 'ws') + 'feed', max_size=None)
+    try:
+        async for frame in websocket:
+            message = json.loads(frame)
+            order_book.process_message(message)
+            latencies.append(time.perf_counter_ns() - message['sent_ns'])
+    finally:
+        stop.set()
+        await asyncio.gather(*tasks)
+        await session.close()
+        executor.shutdown()
+    return latencies
+
+
+def benchmark_latency(args, traders=2):
+    """p50, p99 and max websocket message to book applied latency in microseconds per order entry style."""
+    feed_parameters = {'orders': args.orders, 'levels': args.levels, 'spread': args.spread,
+                       'cancel_ratio': args.cancel_ratio, 'match_ratio': args.match_ratio,
+                       'change_ratio': args.change_ratio, 'seed': args.seed}
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for order_entry in ('executor', 'asyncio'):
+        ports = context.Queue()
+        server = context.Process(target=latency_server, args=(feed_parameters, args.latency, args.feed_rate, ports),
+                                 daemon=True)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{0}/'.format(ports.get(timeout=60))
+            latencies = numpy.array(asyncio.run(measure_latency(url, order_entry, traders))) / 1000.0
+        finally:
+            server.terminate()
+            server.join()
+        results[order_entry] = {'p50_us': float(numpy.percentile(latencies, 50)),
+                                'p99_us': float(numpy.percentile(latencies, 99)),
+                                'max_us': float(latencies.max()), 'messages': len(latencies)}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    feed = SyntheticFeed(orders=args.orders, levels=args.levels, spread=args.spread, cancel_ratio=args.cancel_ratio,
+                         match_ratio=args.match_ratio, change_ratio=args.change_ratio, seed=args.seed)
+    beginning_level_3 = feed.snapshot()
+    messages = list(feed.messages(args.messages))
+
+    results = {'commit': git_commit(),
+               'python': platform.python_version(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'parameters': {name: value for name, value in vars(args).items()
+                              if name not in ('output', 'compare')},
+               'operations_per_sec': {}}
+    product_snapshots, product_messages = product_feeds(args)
+    tree_snapshot = beginning_level_3
+    if args.snapshot:
+        with open(args.snapshot) as snapshot_file:
+            tree_snapshot = json.load(snapshot_file)
+    for fixed_point in (False, True):
+        mode = 'fixed_point' if fixed_point else 'decimal'
+        rates = benchmark_tree(tree_snapshot, fixed_point, args.repeat)
+        rates.update(benchmark_book(beginning_level_3, messages, fixed_point, args.repeat))
+        rates.update(benchmark_manager(product_snapshots, product_messages, fixed_point, args.repeat))
+        results['operations_per_sec'][mode] = rates
+    if args.workers != 'none':
+        workers = [int(count) for count in args.workers.split(',')]
+        results['operations_per_sec']['pipeline'] = benchmark_pipeline(beginning_level_3, messages, workers,
+                                                                       args.repeat)
+    if args.latency:
+        results['latency'] = benchmark_latency(args)
+    return results
+
+
+def compare(results, baseline):
+    for mode, rates in sorted(results['operations_per_sec'].items()):
+        for name, rate in sorted(rates.items()):
+            previous = baseline['operations_per_sec'].get(mode, {}).get(name)
+            change = ' ({0:+.1%} vs {1})'.format(rate / previous - 1, baseline.get('commit')) if previous else ''
+            print('{0:12} {1:18} {2:12.0f}/s{3}'.format(mode, name, rate, change))
+    for order_entry, latency in sorted(results.get('latency', {}).items()):
+        print('{0:12} recv to applied    p50 {1:.0f}us p99 {2:.0f}us max {3:.0f}us'.format(
+            order_entry, latency['p50_us'], latency['p99_us'], latency['max_us']))
+
+
+if __name__ == '__main__':
+    args = ARGS.parse_args()
+    results = run(args)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=4, sort_keys=True)
+    baseline = {'operations_per_sec': {}}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    compare(results, baseline)
@@ -0,0 +1 @@
+# latency probes and off-thread logging shared by the orderbook and trading packages, importing neither
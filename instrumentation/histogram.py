@@ -0,0 +1,62 @@
+class Histogram(object):
+    """Log-linear histogram of non-negative integers, HDR style, with 8 sub-buckets per power of two.
+
+    Recording is one bit_length and one list increment; values are reported to within 12.5%.
+    """
+
+    def __init__(self):
+        self.counts = [0] * 512
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = 0
+
+    @staticmethod
+    def bucket(value):
+        if value < 16:
+            return value
+        shift = value.bit_length() - 4
+        return (shift << 3) + (value >> shift)
+
+    @staticmethod
+    def bucket_upper_bound(index):
+        if index < 16:
+            return index
+        shift = (index >> 3) - 1
+        return (((index & 7) + 9) << shift) - 1
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+
+    def remove(self, value):
+        """Take back a recorded value. minimum and maximum still cover every value ever recorded."""
+        self.counts[self.bucket(value)] -= 1
+        self.count -= 1
+        self.total -= value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bucket_upper_bound(index), self.maximum)
+        return self.maximum
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        summary = {'count': self.count, 'mean': self.mean, 'min': self.minimum or 0, 'max': self.maximum}
+        for percent in percentiles:
+            summary['p{0}'.format(percent)] = self.percentile(percent)
+        return summary
@@ -0,0 +1,35 @@
+from time import perf_counter_ns
+
+from instrumentation.histogram import Histogram
+
+
+class LatencyProbes(object):
+    """Per-stage latency histograms in nanoseconds, fed from monotonic clock readings.
+
+    Recording is a dict lookup and a histogram increment, cheap enough for every feed message.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, stage, nanoseconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(nanoseconds if nanoseconds > 0 else 0)
+
+    def since(self, stage, start):
+        """Record the time elapsed since start, a perf_counter_ns reading, and return the current reading."""
+        now = perf_counter_ns()
+        self.record(stage, now - start)
+        return now
+
+    def summary(self):
+        return {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+
+    def format(self):
+        return '\n'.join('{0:>20}: n={1} p50={2:.1f}us p99={3:.1f}us max={4:.1f}us'.format(
+            stage, summary['count'], summary['p50'] / 1e3, summary['p99'] / 1e3, summary['max'] / 1e3)
+            for stage, summary in self.summary().items())
+
+probes = LatencyProbes()
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import queue
+import threading
+
+
+class BatchingQueueHandler(logging.Handler):
+    """Hands log records to a background thread that formats and writes them in batches.
+
+    emit() only enqueues the record, so the calling thread never formats a message or touches the disk.
+    When the bounded queue is full the record is dropped and counted rather than blocking the caller.
+    target is a RotatingFileHandler; its formatter and size based rollover are honoured.
+    """
+
+    def __init__(self, target, capacity=10000, batch_size=256):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue.Queue(capacity)
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, name='log writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {'depth': self.depth, 'dropped': self.dropped, 'written': self.written}
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        get_nowait = self.queue.get_nowait
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            self.write(batch)
+            if stop:
+                return
+
+    def write(self, batch):
+        target = self.target
+        target.acquire()
+        try:
+            if target.stream is None:
+                target.stream = target._open()
+            for record in batch:
+                try:
+                    target.stream.write(target.format(record) + target.terminator)
+                except Exception:
+                    target.handleError(record)
+            target.stream.flush()
+            self.written += len(batch)
+            if target.maxBytes and target.stream.tell() >= target.maxBytes:
+                target.doRollover()
+        finally:
+            target.release()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
@@ -3,11 +3,8 @@ from datetime import datetime
 from decimal import Decimal
 import argparse
 
-import functools
-import pytz
-from trading import file_logger as trading_file_logger
-from orderbook import file_logger as order_book_file_logger
-import numpy
+from trading import file_logger as trading_file_logger, queue_handler as trading_queue_handler
+from orderbook import file_logger as order_book_file_logger, queue_handler as order_book_queue_handler
 
 try:
     import ujson as json
@@ -19,50 +16,135 @@ from pprint import pformat
 import random
 from socket import gaierror
 import time
+from time import perf_counter_ns
 
+from aiohttp import web
 from dateutil.tz import tzlocal
 import websockets
 
+from instrumentation.probes import probes
+from trading.exchange import exchange_client
 from trading.openorders import OpenOrders
 from trading.spreads import Spreads
-from orderbook.book import Book
+from orderbook.analytics import BookAnalytics
+from orderbook.book import fetch_price_places
+from orderbook.depth import DepthPublisher
+from orderbook.manager import BookManager
+from orderbook.pipeline import DecodePipeline
+from orderbook.timestamps import parse_time_ns
 from trading.strategies import buyer_strategy
 
 ARGS = argparse.ArgumentParser(description='Coinbase Exchange bot.')
 ARGS.add_argument('--c', action='store_true', dest='command_line', default=False, help='Command line output')
 ARGS.add_argument('--t', action='store_true', dest='trading', default=False, help='Trade')
+ARGS.add_argument('--s', action='store', dest='stats_port', type=int, default=None,
+                  help='Serve latency and book stats as JSON on this port')
+ARGS.add_argument('--p', action='store', dest='product_ids', default='BTC-USD',
+                  help='Comma separated products to track over one websocket, the first one is traded')
+ARGS.add_argument('--w', action='store', dest='decode_workers', type=int, default=0,
+                  help='Decode feed messages in this many worker processes')
+ARGS.add_argument('--d', action='store', dest='depth_levels', type=int, default=0,
+                  help='Publish this many levels per side of every book to shared memory')
 args = ARGS.parse_args()
 
-order_book = Book()
+product_ids = args.product_ids.split(',')
+# fixed point, trade tape and shared memory prices are ints of each product's own price increment, 0.00001
+# for ETH-BTC
+price_places = fetch_price_places(product_ids)
+book_manager = BookManager(product_ids, fixed_point=bool(args.decode_workers), normalized=bool(args.decode_workers),
+                           price_places=price_places)
+order_book = book_manager[book_manager.product_ids[0]]
+book_analytics = BookAnalytics(order_book, max_levels=50)
 open_orders = OpenOrders()
-open_orders.cancel_all()
 spreads = Spreads()
+decode_pipeline = None
+# product_id -> DepthPublisher, for strategies and tools running in other processes
+depth_publishers = {}
 
 
-@asyncio.coroutine
-def websocket_to_order_book():
+def handle_message(message, exchange_time, start):
+    """Apply a decoded feed message and track our own orders, returning False when it was not handled.
+
+    exchange_time is None for frames without a time, such as the subscriptions reply.
+    """
+    if args.command_line and exchange_time is not None and message.get('product_id') == order_book.product_id:
+        order_book.message_rate.add(exchange_time)
+    if not book_manager.process_message(message):
+        print(pformat(message))
+        return False
+    probes.since('process_message', start)
+    if depth_publishers:
+        product_id = message.get('product_id')
+        depth_publisher = depth_publishers.get(product_id)
+        # while a book resyncs its messages are only buffered, so its depth would be republished stale
+        if depth_publisher is not None and not book_manager.synchronizers[product_id].resyncing:
+            depth_publisher.update(message)
+    if args.trading:
+        if 'order_id' in message and message['order_id'] == open_orders.open_ask_order_id:
+            if message['type'] == 'done':
+                open_orders.open_ask_order_id = None
+                open_orders.open_ask_price = None
+                open_orders.open_ask_status = None
+                open_orders.open_ask_rejections = Decimal('0.0')
+                open_orders.open_ask_cancelled = False
+            else:
+                open_orders.open_ask_status = message['type']
+            order_book.updates.notify()
+        elif 'order_id' in message and message['order_id'] == open_orders.open_bid_order_id:
+            if message['type'] == 'done':
+                open_orders.open_bid_order_id = None
+                open_orders.open_bid_price = None
+                open_orders.open_bid_status = None
+                open_orders.open_bid_rejections = Decimal('0.0')
+                open_orders.open_bid_cancelled = False
+            else:
+                open_orders.open_bid_status = message['type']
+            order_book.updates.notify()
+    return True
+
+
+async def apply_decoded():
+    # the workers already parsed the timestamp, so exchange_to_receive here includes the decode time
+    async for message in decode_pipeline.messages():
+        start = perf_counter_ns()
+        exchange_time = message.get('time_ns')
+        if exchange_time is not None:
+            probes.record('exchange_to_receive', time.time_ns() - exchange_time)
+        if not handle_message(message, exchange_time, start):
+            return
+
+
+async def websocket_to_order_book():
     try:
-        coinbase_websocket = yield from websockets.connect("wss://ws-feed.pro.coinbase.com")
+        coinbase_websocket = await websockets.connect("wss://ws-feed.pro.coinbase.com")
     except gaierror:
         order_book_file_logger.error('socket.gaierror - had a problem connecting to Coinbase feed')
         return
 
-    yield from coinbase_websocket.send('{"type": "subscribe", "product_id": "BTC-USD"}')
-
-    messages = []
-    while True:
-        message = yield from coinbase_websocket.recv()
-        message = json.loads(message)
-        messages += [message]
-        if len(messages) > 20:
-            break
+    await coinbase_websocket.send(book_manager.subscribe_message())
 
-    order_book.get_level3()
+    # the snapshots load in the background while the feed is buffered, and again after any sequence gap
+    book_manager.start()
+    if decode_pipeline is not None:
+        applier = asyncio.ensure_future(apply_decoded())
+        # however the applier stops, on an unhandled message or an exception, the connection goes with it
+        applier.add_done_callback(lambda _: asyncio.ensure_future(coinbase_websocket.close()))
+        try:
+            while True:
+                decode_pipeline.submit(await coinbase_websocket.recv())
+        except websockets.ConnectionClosed:
+            order_book_file_logger.error('Websocket closed.')
+            return False
+        finally:
+            if not applier.done():
+                applier.cancel()
+            elif not applier.cancelled() and applier.exception() is not None:
+                order_book_file_logger.error('Applying decoded messages failed', exc_info=applier.exception())
 
-    [order_book.process_message(message) for message in messages if message['sequence'] > order_book.level3_sequence]
-    messages = []
     while True:
-        message = yield from coinbase_websocket.recv()
+        message = await coinbase_websocket.recv()
+        received = perf_counter_ns()
+        received_time = time.time_ns()
         if message is None:
             order_book_file_logger.error('Websocket message is None.')
             return False
@@ -71,67 +153,69 @@ def websocket_to_order_book():
         except TypeError:
             order_book_file_logger.error('JSON did not load, see ' + str(message))
             return False
-        if args.command_line:
-            messages += [datetime.strptime(message['time'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=pytz.UTC)]
-            messages = [message for message in messages if (datetime.now(tzlocal()) - message).seconds < 60]
-            if len(messages) > 2:
-                diff = numpy.diff(messages)
-                diff = [float(sec.microseconds) for sec in diff]
-                order_book.average_rate = numpy.mean(diff)
-                order_book.fastest_rate = min(diff)
-                order_book.slowest_rate = max(diff)
-        if not order_book.process_message(message):
-            print(pformat(message))
+        decoded = probes.since('json_loads', received)
+        exchange_time = message.get('time')
+        if exchange_time is not None:
+            exchange_time = parse_time_ns(exchange_time)
+            probes.record('exchange_to_receive', received_time - exchange_time)
+        if not handle_message(message, exchange_time, decoded):
             return False
-        if args.trading:
-            if 'order_id' in message and message['order_id'] == open_orders.open_ask_order_id:
-                if message['type'] == 'done':
-                    open_orders.open_ask_order_id = None
-                    open_orders.open_ask_price = None
-                    open_orders.open_ask_status = None
-                    open_orders.open_ask_rejections = Decimal('0.0')
-                    open_orders.open_ask_cancelled = False
-                else:
-                    open_orders.open_ask_status = message['type']
-            elif 'order_id' in message and message['order_id'] == open_orders.open_bid_order_id:
-                if message['type'] == 'done':
-                    open_orders.open_bid_order_id = None
-                    open_orders.open_bid_price = None
-                    open_orders.open_bid_status = None
-                    open_orders.open_bid_rejections = Decimal('0.0')
-                    open_orders.open_bid_cancelled = False
-                else:
-                    open_orders.open_bid_status = message['type']
-
-
-def update_balances():
+
+
+async def update_balances():
     while True:
-        open_orders.get_balances()
-        time.sleep(30)
+        await open_orders.get_balances()
+        await asyncio.sleep(30)
 
 
-def update_orders():
-    time.sleep(5)
-    open_orders.cancel_all()
+async def update_orders():
+    await asyncio.sleep(5)
+    await open_orders.cancel_all()
     while True:
-        open_orders.get_open_orders()
-        time.sleep(60*5)
+        await open_orders.get_open_orders()
+        order_book.updates.notify()
+        await asyncio.sleep(60*5)
 
 
-def monitor():
-    time.sleep(5)
+async def monitor(interval=1.0):
+    await asyncio.sleep(5)
     while True:
-        time.sleep(0.001)
+        await asyncio.sleep(interval)
         print('Last message: {0:.6f} secs, '
               'Min ask: {1:.2f}, Max bid: {2:.2f}, Spread: {3:.2f}, '
               'Your ask: {4:.2f}, Your bid: {5:.2f}, Your spread: {6:.2f} '
               'Avg: {7:.10f} Min: {8:.10f} Max: {9:.10f}'.format(
             ((datetime.now(tzlocal()) - order_book.last_time).microseconds * 1e-6),
-            order_book.asks.price_tree.min_key(), order_book.bids.price_tree.max_key(),
-            order_book.asks.price_tree.min_key() - order_book.bids.price_tree.max_key(),
+            order_book.best_ask, order_book.best_bid, order_book.spread,
             open_orders.decimal_open_ask_price, open_orders.decimal_open_bid_price,
             open_orders.decimal_open_ask_price - open_orders.decimal_open_bid_price,
-            order_book.average_rate*1e-6, order_book.fastest_rate*1e-6, order_book.slowest_rate*1e-6), end='\r')
+            order_book.average_rate*1e-6, order_book.fastest_rate*1e-6, order_book.slowest_rate*1e-6))
+        print('Microprice: {0:.4f}, Imbalance: {1:+.3f}, Cost to buy 1 BTC: {2:.2f}'.format(
+            book_analytics.microprice(), book_analytics.imbalance(levels=5), book_analytics.sweep_cost(1.0)[0]))
+        print(probes.format())
+        print('log queues: order book {0}, trading {1}'.format(order_book_queue_handler.stats(),
+                                                              trading_queue_handler.stats()))
+
+
+async def stats(request):
+    return web.json_response({
+        'latency_ns': probes.summary(),
+        'best_bid': str(order_book.best_bid),
+        'best_ask': str(order_book.best_ask),
+        'last_sequence': order_book.last_sequence,
+        'microprice': float(book_analytics.microprice()),
+        'imbalance': float(book_analytics.imbalance(levels=5)),
+        'books': book_manager.stats(),
+        'log_queues': {'order_book': order_book_queue_handler.stats(), 'trading': trading_queue_handler.stats()},
+    })
+
+
+async def serve_stats(port):
+    app = web.Application()
+    app.router.add_get('/stats', stats)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
 
 
 if __name__ == '__main__':
@@ -144,12 +228,20 @@ if __name__ == '__main__':
         command_line = True
 
     loop = asyncio.get_event_loop()
+    if args.decode_workers:
+        decode_pipeline = DecodePipeline(workers=args.decode_workers, price_places=price_places)
+    if args.depth_levels:
+        depth_publishers = {product_id: DepthPublisher(book, levels=args.depth_levels)
+                            for product_id, book in book_manager.books.items()}
     if args.trading:
-        loop.run_in_executor(None, functools.partial(buyer_strategy, order_book, open_orders, spreads))
-        loop.run_in_executor(None, update_balances)
-        loop.run_in_executor(None, update_orders)
+        loop.run_until_complete(exchange_client.warm_up())
+        asyncio.ensure_future(buyer_strategy(order_book, open_orders, spreads), loop=loop)
+        asyncio.ensure_future(update_balances(), loop=loop)
+        asyncio.ensure_future(update_orders(), loop=loop)
     if args.command_line:
-        loop.run_in_executor(None, monitor)
+        asyncio.ensure_future(monitor(), loop=loop)
+    if args.stats_port:
+        loop.run_until_complete(serve_stats(args.stats_port))
     n = 0
     while True:
         start_time = loop.time()
@@ -160,6 +252,7 @@ if __name__ == '__main__':
             n += 1
             sleep_time = (2 ** n) + (random.randint(0, 1000) / 1000)
             order_book_file_logger.error('Websocket connectivity problem, going to sleep for {0}'.format(sleep_time))
-            time.sleep(sleep_time)
+            # sleep in the loop so the strategy tasks keep running
+            loop.run_until_complete(asyncio.sleep(sleep_time))
             if n > 6:
                 n = 0
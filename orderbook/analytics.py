@@ -0,0 +1,108 @@
+from collections import namedtuple
+
+import numpy
+
+from orderbook.fixedpoint import SIZE_PLACES
+
+# one side of the book best price first, as float64 arrays in currency units
+SideArrays = namedtuple('SideArrays', 'prices sizes cumulative_sizes cumulative_notional')
+
+UNIT = 10.0 ** -SIZE_PLACES
+
+
+class BookAnalytics(object):
+    """Vectorized depth and market impact signals over a Book.
+
+    Each side is exported to contiguous NumPy arrays at most once per book state, keyed by the last
+    sequence applied and the top of book notification version, so any number of signals computed
+    between two feed messages share one export. max_levels bounds the export to the levels nearest the
+    top of book; signals that need deeper levels than that see the book as ending there. A tick is the
+    book's price increment, 10 ** -book.price_places.
+    """
+
+    def __init__(self, book, max_levels=None):
+        self.book = book
+        self.tick = 10.0 ** -book.price_places
+        self.max_levels = max_levels
+        self.key = None
+        self.sides = {}
+        self.exports = 0
+
+    def side(self, name):
+        """SideArrays for 'bids' or 'asks', rebuilt only when the book has changed since the last call."""
+        book = self.book
+        key = (book.last_sequence, book.level3_sequence, book.updates.version)
+        if key != self.key:
+            self.key = key
+            self.sides = {}
+        arrays = self.sides.get(name)
+        if arrays is None:
+            arrays = self.sides[name] = self.export(getattr(book, name))
+        return arrays
+
+    def export(self, tree):
+        self.exports += 1
+        levels = tree.top_levels(self.max_levels) if self.max_levels else list(tree.iter_levels())
+        if self.book.fixed_point:
+            prices = numpy.fromiter((level.price for level in levels), numpy.float64, len(levels)) * self.tick
+            sizes = numpy.fromiter((level.size for level in levels), numpy.float64, len(levels)) * UNIT
+        else:
+            prices = numpy.fromiter((level.price for level in levels), numpy.float64, len(levels))
+            sizes = numpy.fromiter((level.size for level in levels), numpy.float64, len(levels))
+        return SideArrays(prices, sizes, numpy.cumsum(sizes), numpy.cumsum(prices * sizes))
+
+    def sweep_cost(self, quantity, side='asks'):
+        """Cost, average price and worst price of taking quantity from side, a buy sweeping the asks.
+
+        quantity may be an array, giving arrays back. Quantities beyond the exported depth give nan.
+        """
+        arrays = self.side(side)
+        quantity = numpy.asarray(quantity, dtype=numpy.float64)
+        if not len(arrays.prices):
+            nan = numpy.full(quantity.shape, numpy.nan)
+            return nan, nan, nan
+        index = numpy.searchsorted(arrays.cumulative_sizes, quantity)
+        available = index < len(arrays.prices)
+        index = numpy.minimum(index, len(arrays.prices) - 1)
+        filled_sizes = arrays.cumulative_sizes[index] - arrays.sizes[index]
+        filled_notional = arrays.cumulative_notional[index] - arrays.prices[index] * arrays.sizes[index]
+        cost = filled_notional + (quantity - filled_sizes) * arrays.prices[index]
+        worst = arrays.prices[index]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            average = cost / quantity
+        cost = numpy.where(available, cost, numpy.nan)
+        return cost, numpy.where(available, average, numpy.nan), numpy.where(available, worst, numpy.nan)
+
+    def microprice(self):
+        """Mid price weighted by the size on the opposite side of the top of book."""
+        bids = self.side('bids')
+        asks = self.side('asks')
+        if not len(bids.prices) or not len(asks.prices):
+            return numpy.nan
+        bid_size = bids.sizes[0]
+        ask_size = asks.sizes[0]
+        return (bids.prices[0] * ask_size + asks.prices[0] * bid_size) / (bid_size + ask_size)
+
+    def imbalance(self, levels=1):
+        """(bid size - ask size) / (bid size + ask size) over the top levels of each side, in [-1, 1]."""
+        bid_size = self.side('bids').sizes[:levels].sum()
+        ask_size = self.side('asks').sizes[:levels].sum()
+        total = bid_size + ask_size
+        return (bid_size - ask_size) / total if total else 0.0
+
+    def depth_at(self, ticks):
+        """Total size resting within ticks of the best price, as (bids, asks). ticks may be an array."""
+        tick = self.tick
+        distance = numpy.asarray(ticks, dtype=numpy.float64) * tick
+        bids = self.side('bids')
+        asks = self.side('asks')
+        bid_depth = numpy.zeros(distance.shape)
+        ask_depth = numpy.zeros(distance.shape)
+        if len(bids.prices):
+            # bid prices descend, so search their negation
+            count = numpy.searchsorted(-bids.prices, -(bids.prices[0] - distance) + tick / 2)
+            bid_depth = numpy.where(count > 0, bids.cumulative_sizes[numpy.maximum(count - 1, 0)], 0.0)
+        if len(asks.prices):
+            count = numpy.searchsorted(asks.prices, asks.prices[0] + distance + tick / 2)
+            ask_depth = numpy.where(count > 0, asks.cumulative_sizes[numpy.maximum(count - 1, 0)], 0.0)
+        return bid_depth, ask_depth
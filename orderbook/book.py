@@ -1,8 +1,8 @@
-from pprint import pformat
 from collections import deque
 from datetime import datetime
 from decimal import Decimal
-from dateutil.parser import parse
+from itertools import groupby
+from operator import itemgetter
 
 try:
     import ujson as json
@@ -10,94 +10,320 @@ except ImportError:
     import json
 
 from dateutil.tz import tzlocal
+from orderbook.events import UpdateNotifier
+from orderbook.stats import RollingStats
+from orderbook.fixedpoint import PRICE_PLACES, from_fixed, increment_places, price_parser, size_to_units, units_to_size
+from orderbook.snapshot import SnapshotParser
+from orderbook.tape import TradeTape
+from orderbook.timestamps import datetime_from_ns, parse_time, parse_time_ns
 from orderbook.tree import Tree
 import requests
-from trading import file_logger
+from orderbook import file_logger
+
+LEVEL3_URL = 'http://api.pro.coinbase.com/products/{0}/book'
+PRODUCTS_URL = 'https://api.pro.coinbase.com/products'
+
+
+def level3_chunks(product_id='BTC-USD', chunk_size=64 * 1024):
+    """Yield the level 3 snapshot body in chunks as it downloads."""
+    with requests.get(LEVEL3_URL.format(product_id), params={'level': 3}, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            yield chunk
+
+
+def fetch_price_places(product_ids):
+    """product_id -> decimal places of its price, from the quote increment the exchange lists for it."""
+    response = requests.get(PRODUCTS_URL)
+    response.raise_for_status()
+    increments = {product['id']: product['quote_increment'] for product in response.json()}
+    return {product_id: increment_places(increments[product_id]) for product_id in product_ids}
 
 
 class Book(object):
-    def __init__(self):
-        self.matches = deque(maxlen=100)
-        self.bids = Tree()
+    def __init__(self, product_id='BTC-USD', fixed_point=False, normalized=False, trades=None,
+                 price_places=PRICE_PLACES):
+        self.product_id = product_id
+        # in fixed point mode prices are int ticks of 10 ** -price_places, cents by default, and sizes int
+        # satoshis, see orderbook.fixedpoint
+        self.fixed_point = fixed_point
+        self.price_places = price_places
+        # normalized feed messages already carry those ints, see orderbook.pipeline
+        if normalized and not fixed_point:
+            raise ValueError('normalized messages need a fixed point book')
+        self.normalized = normalized
+        if fixed_point:
+            self.parse_price = price_parser(price_places)
+            self.parse_size = size_to_units
+        else:
+            self.parse_price = Decimal
+            self.parse_size = Decimal
+        # the trade tape holds fixed point ints in either mode, parsed from the feed's strings unless normalized
+        self.tape_price = int if normalized else price_parser(price_places)
+        self.tape_size = int if normalized else size_to_units
+
+        # every match on the feed, see orderbook.tape; pass trades to set its retention or spill file
+        self.trades = trades if trades is not None else TradeTape()
+        # the matches view, brought up to date with the tape when read
+        self._matches = deque(maxlen=100)
+        self._matches_total = 0
+        self.bids = Tree(is_bid=True)
         self.asks = Tree()
 
+        # fires whenever the best bid or ask price or size changes
+        self.updates = UpdateNotifier()
+        self.bids.listener = self.updates.notify
+        self.asks.listener = self.updates.notify
+
         self.level3_sequence = 0
         self.first_sequence = 0
         self.last_sequence = 0
-        self.last_time = datetime.now(tzlocal())
-        self.average_rate = 0.0
-        self.fastest_rate = 0.0
-        self.slowest_rate = 0.0
+        # sequence gaps seen, so callers can tell a gap from an unhandled message when process_message fails
+        self.gap_count = 0
+        self._last_time = datetime.now(tzlocal())
+        self._last_time_string = None
+        # inter-arrival times of feed messages over the last 60 seconds, in microseconds
+        self.message_rate = RollingStats()
+
+        self.handlers = {}
+        self.unsequenced_handlers = {}
+        self.register_default_handlers()
 
     def get_level3(self, json_doc=None):
         if not json_doc:
-            json_doc = requests.get('http://api.pro.coinbase.com/products/BTC-USD/book', params={'level': 3}).json()
-        [self.bids.insert_order(bid[2], Decimal(bid[1]), Decimal(bid[0]), initial=True) for bid in json_doc['bids']]
-        [self.asks.insert_order(ask[2], Decimal(ask[1]), Decimal(ask[0]), initial=True) for ask in json_doc['asks']]
+            return self.stream_level3(level3_chunks(self.product_id))
+        parse_price = self.parse_price
+        parse_size = self.parse_size
+        self.bids.load_orders((parse_price(price), parse_size(size), order_id)
+                              for price, size, order_id in json_doc['bids'])
+        self.asks.load_orders((parse_price(price), parse_size(size), order_id)
+                              for price, size, order_id in json_doc['asks'])
         self.level3_sequence = json_doc['sequence']
 
-    def process_message(self, message):
+    def stream_level3(self, chunks):
+        """Load a level 3 snapshot from the chunks of its JSON document, parsing orders as they arrive."""
+        parse_price = self.parse_price
+        parse_size = self.parse_size
+        parser = SnapshotParser()
+        for side, orders in groupby(parser.parse(chunks), key=itemgetter(0)):
+            tree = self.bids if side == 'bids' else self.asks
+            tree.load_orders((parse_price(price), parse_size(size), order_id) for _, price, size, order_id in orders)
+        self.level3_sequence = parser.sequence
 
-        new_sequence = int(message['sequence'])
+    def adopt(self, other):
+        """Take over the trees and sequence state of other, a book loaded from a fresh snapshot.
 
-        if new_sequence <= self.level3_sequence:
-            return True
+        Nothing here awaits, so coroutines see either the old book or the new one, never a mix.
+        """
+        self.bids = other.bids
+        self.asks = other.asks
+        self.bids.listener = self.updates.notify
+        self.asks.listener = self.updates.notify
+        self.register_default_handlers()
+        self.trades.extend(other.trades)
+        self.level3_sequence = other.level3_sequence
+        self.first_sequence = other.first_sequence
+        self.last_sequence = other.last_sequence
+        self._last_time = other._last_time
+        self._last_time_string = other._last_time_string
+        self.updates.notify()
 
-        if not self.first_sequence:
-            self.first_sequence = new_sequence
-            self.last_sequence = new_sequence
-            assert new_sequence - self.level3_sequence == 1
+    @property
+    def last_time(self):
+        # the feed timestamp is only parsed when somebody asks for it
+        if self._last_time_string is not None:
+            self._last_time = parse_time(self._last_time_string)
+            self._last_time_string = None
+        return self._last_time
+
+    @property
+    def matches(self):
+        """The last 100 trades, newest first, as (datetime, maker side, Decimal size, Decimal price).
+
+        Only the trades added to the tape since the last read are converted; use self.trades for the raw
+        fixed point columns.
+        """
+        matches = self._matches
+        added = self.trades.total - self._matches_total
+        if added:
+            price_places = self.price_places
+            matches.extendleft((datetime_from_ns(time_ns), 'buy' if side > 0 else 'sell', units_to_size(size),
+                                from_fixed(price, price_places))
+                               for time_ns, side, price, size in reversed(self.trades.last(min(added, 100))))
+            self._matches_total = self.trades.total
+        return matches
+
+    @property
+    def average_rate(self):
+        return self.message_rate.mean
+
+    @property
+    def fastest_rate(self):
+        return self.message_rate.minimum
+
+    @property
+    def slowest_rate(self):
+        return self.message_rate.maximum
+
+    def decimal_price(self, price):
+        return from_fixed(price, self.price_places) if self.fixed_point else price
+
+    def decimal_size(self, size):
+        return units_to_size(size) if self.fixed_point else size
+
+    @property
+    def best_bid(self):
+        price = self.bids.best_price
+        return self.decimal_price(price) if price is not None else None
+
+    @property
+    def best_ask(self):
+        price = self.asks.best_price
+        return self.decimal_price(price) if price is not None else None
+
+    @property
+    def best_bid_size(self):
+        size = self.bids.best_size
+        return self.decimal_size(size) if size is not None else None
+
+    @property
+    def best_ask_size(self):
+        size = self.asks.best_size
+        return self.decimal_size(size) if size is not None else None
+
+    @property
+    def spread(self):
+        if self.bids.best_price is None or self.asks.best_price is None:
+            return None
+        return self.decimal_price(self.asks.best_price - self.bids.best_price)
+
+    def depth(self, count=10):
+        """The top count levels of each side as (price, size, order count), best first."""
+        return {name: [(self.decimal_price(level.price), self.decimal_size(level.size), level.count)
+                       for level in tree.top_levels(count)]
+                for name, tree in (('bids', self.bids), ('asks', self.asks))}
+
+    @property
+    def top_of_book_version(self):
+        # changes whenever the best price or the size at the best price changes on either side
+        return self.bids.top_version + self.asks.top_version
+
+    def register_handler(self, message_type, side, handler, sequenced=True):
+        """Route messages of this type and side to handler(message), which returns False on failure.
+
+        Sequenced handlers go through the sequence gap check; unsequenced ones (side None) are only
+        looked up when a message misses the sequenced table, so they cost the common path nothing.
+        """
+        if sequenced:
+            self.handlers[(message_type, side)] = handler
         else:
-            if (new_sequence - self.last_sequence) != 1:
-                file_logger.error('sequence gap: {0}'.format(new_sequence - self.last_sequence))
-                return False
-            self.last_sequence = new_sequence
+            self.unsequenced_handlers[message_type] = handler
 
-        if 'order_type' in message and message['order_type'] == 'market':
-            return True
+    def register_default_handlers(self):
+        for side, tree in (('buy', self.bids), ('sell', self.asks)):
+            for message_type, handler in self.side_handlers(side, tree).items():
+                self.register_handler(message_type, side, handler)
+        self.register_handler('heartbeat', None, self.handle_ignored, sequenced=False)
+        self.register_handler('ticker', None, self.handle_ignored, sequenced=False)
+        self.register_handler('subscriptions', None, self.handle_ignored, sequenced=False)
+        # stop orders being activated carry a timestamp but no sequence or time
+        self.register_handler('activate', None, self.handle_ignored, sequenced=False)
 
-        message_type = message['type']
-        message_time = parse(message['time'])
-        self.last_time = message_time
-        side = message['side']
+    def side_handlers(self, side, tree):
+        # closures bound to one tree, so the hot path does no side or attribute lookups
+        parse_price = int if self.normalized else self.parse_price
+        parse_size = int if self.normalized else self.parse_size
+        receive = tree.receive
+        insert_order = tree.insert_order
+        match = tree.match
+        remove_order = tree.remove_order
+        change = tree.change
+        add_trade = self.trades.add
+        side_code = 1 if side == 'buy' else -1
+        fixed_point = self.fixed_point
+        tape_price = self.tape_price
+        tape_size = self.tape_size
 
-        if message_type == 'received' and side == 'buy':
-            self.bids.receive(message['order_id'], message['size'])
-            return True
-        elif message_type == 'received' and side == 'sell':
-            self.asks.receive(message['order_id'], message['size'])
+        def received(message):
+            if message.get('order_type') == 'market':
+                return True
+            receive(message['order_id'], message['size'])
             return True
 
-        elif message_type == 'open' and side == 'buy':
-            self.bids.insert_order(message['order_id'], Decimal(message['remaining_size']), Decimal(message['price']))
-            return True
-        elif message_type == 'open' and side == 'sell':
-            self.asks.insert_order(message['order_id'], Decimal(message['remaining_size']), Decimal(message['price']))
+        def open_order(message):
+            insert_order(message['order_id'], parse_size(message['remaining_size']), parse_price(message['price']))
             return True
 
-        elif message_type == 'match' and side == 'buy':
-            self.bids.match(message['maker_order_id'], Decimal(message['size']))
-            self.matches.appendleft((message_time, side, Decimal(message['size']), Decimal(message['price'])))
-            return True
-        elif message_type == 'match' and side == 'sell':
-            self.asks.match(message['maker_order_id'], Decimal(message['size']))
-            self.matches.appendleft((message_time, side, Decimal(message['size']), Decimal(message['price'])))
+        def matched(message):
+            size = parse_size(message['size'])
+            match(message['maker_order_id'], size)
+            time_ns = message.get('time_ns')
+            if time_ns is None:
+                time_ns = parse_time_ns(message['time'])
+            if fixed_point:
+                add_trade(time_ns, side_code, parse_price(message['price']), size)
+            else:
+                add_trade(time_ns, side_code, tape_price(message['price']), tape_size(message['size']))
             return True
 
-        elif message_type == 'done' and side == 'buy':
-            self.bids.remove_order(message['order_id'])
-            return True
-        elif message_type == 'done' and side == 'sell':
-            self.asks.remove_order(message['order_id'])
+        def done(message):
+            remove_order(message['order_id'])
             return True
 
-        elif message_type == 'change' and side == 'buy':
-            self.bids.change(message['order_id'], Decimal(message['new_size']))
+        def changed(message):
+            change(message['order_id'], parse_size(message['new_size']))
             return True
-        elif message_type == 'change' and side == 'sell':
-            self.asks.change(message['order_id'], Decimal(message['new_size']))
+
+        return {'received': received, 'open': open_order, 'match': matched, 'done': done, 'change': changed}
+
+    def process_message(self, message):
+        handler = self.handlers.get((message['type'], message.get('side')))
+        if handler is None:
+            handler = self.unsequenced_handlers.get(message['type'])
+            if handler is not None or 'sequence' not in message:
+                return self.process_unsequenced_message(message)
+            # an unknown type still takes its sequence number, or the next message would look like a gap
+            handler = self.handle_unhandled
+
+        new_sequence = int(message['sequence'])
+
+        if new_sequence <= self.level3_sequence:
             return True
 
+        if not self.first_sequence:
+            if new_sequence - self.level3_sequence != 1:
+                file_logger.error('sequence gap after snapshot: %s', new_sequence - self.level3_sequence)
+                self.gap_count += 1
+                return False
+            self.first_sequence = new_sequence
+            self.last_sequence = new_sequence
         else:
-            file_logger.error('Unhandled message: {0}'.format(pformat(message)))
-            return False
+            if (new_sequence - self.last_sequence) != 1:
+                file_logger.error('sequence gap: %s', new_sequence - self.last_sequence)
+                self.gap_count += 1
+                return False
+            self.last_sequence = new_sequence
+
+        self._last_time_string = message.get('time')
+        return handler(message)
+
+    def record_trade(self, message):
+        """Add a match message to the tape without applying it to the book, for a match the snapshot holds."""
+        time_ns = message.get('time_ns')
+        if time_ns is None:
+            time_ns = parse_time_ns(message['time'])
+        self.trades.add(time_ns, 1 if message['side'] == 'buy' else -1, self.tape_price(message['price']),
+                        self.tape_size(message['size']))
+
+    def process_unsequenced_message(self, message):
+        handler = self.unsequenced_handlers.get(message['type'], self.handle_unhandled)
+        return handler(message)
+
+    @staticmethod
+    def handle_unhandled(message):
+        file_logger.error('Unhandled message: %s', message)
+        return False
+
+    @staticmethod
+    def handle_ignored(message):
+        return True
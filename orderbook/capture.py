@@ -0,0 +1,75 @@
+# Append-only binary recordings of the websocket feed. A capture starts with MAGIC, followed by one
+# record per frame: a little-endian header of the local receive time in epoch nanoseconds and the
+# frame length, then the raw frame bytes. Captures may be gzip compressed.
+import gzip
+import mmap
+import struct
+import time
+
+MAGIC = b'CBXCAP1\n'
+RECORD_HEADER = struct.Struct('<qI')
+
+
+class CaptureWriter(object):
+    def __init__(self, path, compress=False):
+        self.path = path
+        if compress:
+            self.file = gzip.open(path, 'wb', compresslevel=1)
+        else:
+            self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.records = 0
+
+    def write(self, frame, receive_time=None):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        if receive_time is None:
+            receive_time = time.time_ns()
+        self.file.write(RECORD_HEADER.pack(receive_time, len(frame)))
+        self.file.write(frame)
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_capture(path):
+    """Yield (receive_time, frame) for every record, in constant memory."""
+    with open(path, 'rb') as capture_file:
+        compressed = capture_file.read(2) == b'\x1f\x8b'
+    if compressed:
+        yield from read_stream(gzip.open(path, 'rb'))
+    else:
+        yield from read_mapped(path)
+
+
+def read_stream(capture_file):
+    with capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a feed capture')
+        header_size = RECORD_HEADER.size
+        while True:
+            header = capture_file.read(header_size)
+            if len(header) < header_size:
+                return
+            receive_time, length = RECORD_HEADER.unpack(header)
+            yield receive_time, capture_file.read(length)
+
+
+def read_mapped(path):
+    with open(path, 'rb') as capture_file, mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a feed capture')
+        offset = len(MAGIC)
+        end = len(mapped) - RECORD_HEADER.size
+        while offset <= end:
+            receive_time, length = RECORD_HEADER.unpack_from(mapped, offset)
+            offset += RECORD_HEADER.size
+            yield receive_time, mapped[offset:offset + length]
+            offset += length
@@ -0,0 +1,167 @@
+# Top of book depth published into a memory mapped file for readers in other processes. The file is an
+# array of native int64 words: a header of HEADER_WORDS words, then levels (price, size, order count)
+# triples for the bids, best first, then the same for the asks. Prices and sizes are fixed point ints
+# with the places given in the header. Word 0 is a seqlock: the writer makes it odd before changing
+# anything and even again afterwards, and readers retry until they see the same even value around
+# their copy, so they never see a half written book and never block the writer.
+from array import array
+from decimal import Decimal
+import mmap
+import os
+import time
+
+from orderbook.fixedpoint import SIZE_PLACES
+from orderbook.timestamps import parse_time_ns
+
+LOCK = 0
+SEQUENCE = 1
+TIME = 2
+LEVELS = 3
+BID_COUNT = 4
+ASK_COUNT = 5
+PRICE_PLACES_WORD = 6
+SIZE_PLACES_WORD = 7
+HEADER_WORDS = 8
+WORD_SIZE = 8
+BOOK_TYPES = frozenset(('open', 'done', 'match', 'change'))
+
+
+def depth_path(product_id):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+    return os.path.join(directory, 'coinbase_depth_{0}'.format(product_id))
+
+
+class DepthPublisher(object):
+    """Publishes the top levels of each side of book, with its sequence and time, for other processes.
+
+    Call update(message) after book has processed message, but not while its BookSynchronizer is
+    resyncing and only buffering the messages. The levels are only rewritten when the
+    message touched a price within the published depth, or the top of book changed, otherwise just the
+    sequence and time move on.
+    """
+
+    def __init__(self, book, path=None, levels=10):
+        self.book = book
+        self.path = path or depth_path(book.product_id)
+        self.levels = levels
+        size = (HEADER_WORDS + 6 * levels) * WORD_SIZE
+        with open(self.path, 'w+b') as depth_file:
+            depth_file.truncate(size)
+            self.map = mmap.mmap(depth_file.fileno(), size)
+        self.words = memoryview(self.map).cast('q')
+        self.words[LEVELS] = levels
+        self.words[PRICE_PLACES_WORD] = book.price_places
+        self.words[SIZE_PLACES_WORD] = SIZE_PLACES
+        # the worst published price per side, a change beyond it cannot show in the published depth
+        self.bid_limit = None
+        self.ask_limit = None
+        self.dirty = True
+        self.parse_price = int if book.normalized else book.parse_price
+        book.updates.subscribe(self.top_changed)
+
+    def top_changed(self, version):
+        self.dirty = True
+
+    def affects(self, message):
+        if message['type'] not in BOOK_TYPES:
+            return False
+        price = message.get('price')
+        if price is None:
+            return False
+        price = self.parse_price(price)
+        if message['side'] == 'buy':
+            return self.bid_limit is None or price >= self.bid_limit
+        return self.ask_limit is None or price <= self.ask_limit
+
+    def update(self, message):
+        time_ns = message.get('time_ns')
+        if time_ns is None:
+            time = message.get('time')
+            if time is None:
+                # activate frames and the like carry no time and leave the book as it was
+                return
+            time_ns = parse_time_ns(time)
+        if self.dirty or self.affects(message):
+            self.publish(time_ns)
+        else:
+            words = self.words
+            words[LOCK] += 1
+            words[SEQUENCE] = self.book.last_sequence
+            words[TIME] = time_ns
+            words[LOCK] += 1
+
+    def side_words(self, side_levels):
+        if self.book.fixed_point:
+            words = [value for level in side_levels for value in (level.price, level.size, level.count)]
+        else:
+            price_places = self.book.price_places
+            words = [value for level in side_levels
+                     for value in (int(level.price.scaleb(price_places)), int(level.size.scaleb(SIZE_PLACES)),
+                                   level.count)]
+        return words + [0] * (3 * (self.levels - len(side_levels)))
+
+    def publish(self, time_ns=0):
+        book = self.book
+        bids = book.bids.top_levels(self.levels)
+        asks = book.asks.top_levels(self.levels)
+        body = array('q', self.side_words(bids) + self.side_words(asks))
+        words = self.words
+        words[LOCK] += 1
+        words[SEQUENCE] = book.last_sequence
+        words[TIME] = time_ns
+        words[BID_COUNT] = len(bids)
+        words[ASK_COUNT] = len(asks)
+        words[HEADER_WORDS:HEADER_WORDS + len(body)] = body
+        words[LOCK] += 1
+        self.bid_limit = bids[-1].price if len(bids) == self.levels else None
+        self.ask_limit = asks[-1].price if len(asks) == self.levels else None
+        self.dirty = False
+
+    def close(self):
+        self.book.updates.unsubscribe(self.top_changed)
+        self.words.release()
+        self.map.close()
+        os.remove(self.path)
+
+
+class DepthReader(object):
+    """Reads consistent depth snapshots published by a DepthPublisher, from any process."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as depth_file:
+            self.map = mmap.mmap(depth_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # the raw words, for readers that want to pick single fields without copying
+        self.words = memoryview(self.map).cast('q')
+        self.levels = self.words[LEVELS]
+        self.price_scale = Decimal(1).scaleb(-self.words[PRICE_PLACES_WORD])
+        self.size_scale = Decimal(1).scaleb(-self.words[SIZE_PLACES_WORD])
+        self.retries = 0
+
+    def read(self):
+        """Return sequence, time_ns, and bids and asks as lists of (price, size, count) fixed point ints."""
+        words = self.words
+        end = HEADER_WORDS + 6 * self.levels
+        while True:
+            lock = words[LOCK]
+            if not lock & 1:
+                header = words[:HEADER_WORDS].tolist()
+                body = words[HEADER_WORDS:end].tolist()
+                if words[LOCK] == lock:
+                    break
+            self.retries += 1
+            time.sleep(0)
+        bid_count = header[BID_COUNT]
+        ask_count = header[ASK_COUNT]
+        asks_start = 3 * self.levels
+        return {'sequence': header[SEQUENCE],
+                'time_ns': header[TIME],
+                'bids': [tuple(body[3 * index:3 * index + 3]) for index in range(bid_count)],
+                'asks': [tuple(body[asks_start + 3 * index:asks_start + 3 * index + 3]) for index in range(ask_count)]}
+
+    def decimal_level(self, level):
+        price, size, count = level
+        return price * self.price_scale, size * self.size_scale, count
+
+    def close(self):
+        self.words.release()
+        self.map.close()
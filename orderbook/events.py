@@ -0,0 +1,42 @@
+import asyncio
+from time import perf_counter_ns
+
+
+class UpdateNotifier(object):
+    """Publishes change events to callbacks and to coroutines waiting in the asyncio loop.
+
+    notify() must be called from the thread running the loop, which is where Book.process_message runs.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.callbacks = []
+        self.waiters = []
+        # perf_counter_ns reading of the last notification, for measuring how fast consumers react
+        self.notified_at = 0
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+    def notify(self):
+        self.version += 1
+        self.notified_at = perf_counter_ns()
+        for callback in self.callbacks:
+            callback(self.version)
+        if self.waiters:
+            waiters = self.waiters
+            self.waiters = []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(self.version)
+
+    async def wait(self, version=None):
+        """Return the current version once it differs from version, which is what the caller last saw."""
+        if version is None or version != self.version:
+            return self.version
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        return await waiter
@@ -0,0 +1,53 @@
+from decimal import Decimal
+from functools import partial
+
+# prices are held as integer ticks (cents), sizes as integer base units (satoshis); products quoted to
+# more places than PRICE_PLACES, such as ETH-BTC, get their own places, see price_parser
+PRICE_PLACES = 2
+SIZE_PLACES = 8
+
+
+def from_fixed(value, places):
+    return Decimal(value).scaleb(-places)
+
+
+def check_places(value, fraction, places):
+    # trailing zeros are harmless, any other digit past places would be silently dropped
+    if fraction[places:].strip('0'):
+        raise ValueError('{0} has more than {1} decimal places'.format(value, places))
+
+
+def to_fixed(value, places):
+    """Parse a decimal string from the feed straight into an integer of 10 ** -places, without a Decimal."""
+    whole, _, fraction = value.partition('.')
+    if len(fraction) > places:
+        check_places(value, fraction, places)
+    return int(whole + (fraction + '0' * places)[:places])
+
+
+def price_to_ticks(value):
+    return to_fixed(value, PRICE_PLACES)
+
+
+def size_to_units(value):
+    return to_fixed(value, SIZE_PLACES)
+
+
+def price_parser(places=PRICE_PLACES):
+    """price_to_ticks for prices with places decimal places, ticks being 10 ** -places."""
+    if places == PRICE_PLACES:
+        return price_to_ticks
+    return partial(to_fixed, places=places)
+
+
+def increment_places(increment):
+    """Decimal places of a product's quote_increment, '0.00001' being 5."""
+    return max(-Decimal(increment).normalize().as_tuple().exponent, 0)
+
+
+def ticks_to_price(value):
+    return from_fixed(value, PRICE_PLACES)
+
+
+def units_to_size(value):
+    return from_fixed(value, SIZE_PLACES)
@@ -0,0 +1,60 @@
+from functools import partial
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from orderbook.book import Book
+from orderbook.fixedpoint import PRICE_PLACES
+from orderbook.resync import BookSynchronizer
+
+
+class BookManager(object):
+    """One Book per product, all fed from a single websocket subscription.
+
+    Messages are routed by product_id to the BookSynchronizer of their product, so each book loads its
+    snapshot and recovers from gaps on its own while the others keep processing. fetch, if given, is
+    called with a product id and returns its snapshot document, as for BookSynchronizer. price_places
+    maps product ids to the decimal places of their prices for fixed point books, see fetch_price_places.
+    """
+
+    def __init__(self, product_ids, fixed_point=False, fetch=None, normalized=False, price_places=None):
+        self.product_ids = list(product_ids)
+        self.books = {}
+        self.synchronizers = {}
+        for product_id in self.product_ids:
+            book = self.books[product_id] = Book(product_id=product_id, fixed_point=fixed_point,
+                                                 normalized=normalized,
+                                                 price_places=(price_places or {}).get(product_id, PRICE_PLACES))
+            self.synchronizers[product_id] = BookSynchronizer(
+                book, fetch=partial(fetch, product_id) if fetch is not None else None)
+        # product_id -> bound process_message, so routing costs one dict lookup
+        self.routes = {product_id: synchronizer.process_message
+                       for product_id, synchronizer in self.synchronizers.items()}
+
+    def __getitem__(self, product_id):
+        return self.books[product_id]
+
+    def subscribe_message(self):
+        return json.dumps({'type': 'subscribe', 'product_ids': self.product_ids})
+
+    def start(self):
+        """Load every product's snapshot, concurrently on executor threads, buffering the feed meanwhile."""
+        for synchronizer in self.synchronizers.values():
+            synchronizer.start()
+
+    @property
+    def resyncing(self):
+        return any(synchronizer.resyncing for synchronizer in self.synchronizers.values())
+
+    def process_message(self, message):
+        route = self.routes.get(message.get('product_id'))
+        if route is None:
+            # subscription confirmations and the like belong to no product
+            return self.books[self.product_ids[0]].process_unsequenced_message(message)
+        return route(message)
+
+    def stats(self):
+        return {product_id: dict(synchronizer.stats(), last_sequence=self.books[product_id].last_sequence)
+                for product_id, synchronizer in self.synchronizers.items()}
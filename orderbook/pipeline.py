@@ -0,0 +1,234 @@
+import asyncio
+from collections import deque
+import marshal
+import multiprocessing
+import os
+import time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from orderbook.fixedpoint import price_parser, price_to_ticks, size_to_units
+from orderbook.ring import RingBuffer
+from orderbook.timestamps import parse_time_ns
+
+# the key of the record a worker sends back in place of a frame it could not decode
+DECODE_ERROR = 'decode_error'
+PRICE_FIELDS = ('price',)
+SIZE_FIELDS = ('size', 'remaining_size', 'new_size', 'old_size')
+# spins before an idle side starts sleeping between polls
+SPINS = 200
+
+
+def backoff(idle):
+    if idle > SPINS:
+        time.sleep(0.0001)
+    return idle + 1
+
+
+def normalize(message, price_parsers=None):
+    """Convert the prices and sizes of a decoded feed message to fixed point ints and add time_ns.
+
+    price_parsers maps product ids to their price parser, for products not quoted to PRICE_PLACES.
+    """
+    parse_price = price_to_ticks
+    if price_parsers:
+        parse_price = price_parsers.get(message.get('product_id'), price_to_ticks)
+    for field in PRICE_FIELDS:
+        value = message.get(field)
+        if value is not None:
+            message[field] = parse_price(value)
+    for field in SIZE_FIELDS:
+        value = message.get(field)
+        if value is not None:
+            message[field] = size_to_units(value)
+    if 'time' in message:
+        message['time_ns'] = parse_time_ns(message['time'])
+    return message
+
+
+def decode_worker(input_name, output_name, capacity, fixed_point, price_places, wake):
+    price_parsers = {product_id: price_parser(places) for product_id, places in price_places.items()}
+    # raw single byte writes, a full pipe already holds enough wake ups for the reader
+    wake_fd = wake.fileno()
+    os.set_blocking(wake_fd, False)
+    frames = RingBuffer(capacity, name=input_name)
+    results = RingBuffer(capacity, name=output_name)
+    idle = 0
+    while True:
+        frame = frames.get()
+        if frame is None:
+            idle = backoff(idle)
+            continue
+        idle = 0
+        if not frame:
+            break
+        try:
+            message = json.loads(frame)
+            if fixed_point:
+                normalize(message, price_parsers)
+        except Exception as error:
+            # sent back in the frame's place, so the worker lives on and the failure surfaces in order
+            message = {DECODE_ERROR: '{0}: {1}'.format(type(error).__name__, error), 'frame': frame}
+        payload = marshal.dumps(message)
+        while not results.put(payload):
+            idle = backoff(idle)
+        idle = 0
+        try:
+            os.write(wake_fd, b'\0')
+        except BlockingIOError:
+            pass
+    frames.close()
+    results.close()
+    wake.close()
+
+
+class DecodePipeline(object):
+    """Decodes feed frames in worker processes and hands them back in exactly the order submitted.
+
+    Frames go round robin to the workers over shared memory rings and results are collected round robin
+    from them, so ordering needs no sequence tracking or reorder buffer. Each result also writes a byte to
+    a pipe the event loop watches, so messages() sleeps until there is something to collect instead of
+    polling the rings. Results cross back as marshal
+    records, which load several times faster than the JSON they came from. With fixed_point, prices and
+    sizes come back as ints for a Book(fixed_point=True, normalized=True), prices in the places given
+    per product by price_places, PRICE_PLACES for products it leaves out.
+
+    A frame a worker cannot decode raises ValueError where its message would have been yielded, and a
+    worker that dies makes the calls that wait on it raise RuntimeError rather than wait forever.
+    """
+
+    def __init__(self, workers=2, fixed_point=True, capacity=1 << 22, price_places=None):
+        context = multiprocessing.get_context('spawn')
+        price_places = dict(price_places or {})
+        self.inputs = [RingBuffer(capacity) for _ in range(workers)]
+        self.outputs = [RingBuffer(capacity) for _ in range(workers)]
+        self.wake_reader, wake_writer = context.Pipe(duplex=False)
+        self.processes = [context.Process(target=decode_worker, name='decode worker',
+                                          args=(frames.name, results.name, capacity, fixed_point, price_places,
+                                                wake_writer), daemon=True)
+                          for frames, results in zip(self.inputs, self.outputs)]
+        for process in self.processes:
+            process.start()
+        wake_writer.close()
+        self.wake_fd = self.wake_reader.fileno()
+        os.set_blocking(self.wake_fd, False)
+        self.next_input = 0
+        self.next_output = 0
+        # submitted frames not yet collected from the workers
+        self.pending = 0
+        self.decoded = deque()
+        self.woken = asyncio.Event()
+        # indexes of workers seen to exit while messages() was waiting
+        self.exited = []
+
+    def submit(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        frames = self.inputs[self.next_input]
+        idle = 0
+        while not frames.put(frame):
+            # the worker may be stuck on a full output ring, so keep collecting while waiting
+            self.collect()
+            self.check_worker(self.next_input)
+            idle = backoff(idle)
+        self.next_input = (self.next_input + 1) % len(self.inputs)
+        self.pending += 1
+
+    def collect(self):
+        outputs = self.outputs
+        while self.pending:
+            payload = outputs[self.next_output].get()
+            if payload is None:
+                if self.processes[self.next_output].is_alive():
+                    return
+                # the worker may have published its last result just before it exited
+                payload = outputs[self.next_output].get()
+                if payload is None:
+                    self.check_worker(self.next_output)
+            self.next_output = (self.next_output + 1) % len(outputs)
+            self.pending -= 1
+            self.decoded.append(marshal.loads(payload))
+
+    def check_worker(self, index):
+        process = self.processes[index]
+        if not process.is_alive():
+            raise RuntimeError('decode worker {0} exited with code {1}'.format(index, process.exitcode))
+
+    def ready(self):
+        """Yield the decoded messages available now, stopping at the first one still in a worker."""
+        self.collect()
+        decoded = self.decoded
+        while decoded:
+            message = decoded.popleft()
+            if DECODE_ERROR in message:
+                raise ValueError('could not decode {0!r}, {1}'.format(message['frame'], message[DECODE_ERROR]))
+            yield message
+
+    def drain(self):
+        """Yield every submitted message, waiting for the workers to finish them."""
+        idle = 0
+        while self.pending or self.decoded:
+            for message in self.ready():
+                idle = 0
+                yield message
+            idle = backoff(idle)
+
+    def wake(self):
+        try:
+            while os.read(self.wake_fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self.woken.set()
+
+    def worker_exited(self, index):
+        # a sentinel stays readable once its process is gone, so it is only watched until then
+        asyncio.get_running_loop().remove_reader(self.processes[index].sentinel)
+        self.exited.append(index)
+        self.woken.set()
+
+    async def messages(self):
+        """Yield decoded messages as the workers finish them, without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.wake_fd, self.wake)
+        for index, process in enumerate(self.processes):
+            loop.add_reader(process.sentinel, self.worker_exited, index)
+        try:
+            while True:
+                # cleared before looking, so a result that lands after the look still wakes us
+                self.woken.clear()
+                for message in self.ready():
+                    yield message
+                if self.exited:
+                    # frames submitted to it would never come back
+                    self.check_worker(self.exited[0])
+                await self.woken.wait()
+        finally:
+            loop.remove_reader(self.wake_fd)
+            for index, process in enumerate(self.processes):
+                if index not in self.exited:
+                    loop.remove_reader(process.sentinel)
+
+    def close(self):
+        """Stop the workers and free the rings, raising RuntimeError if a worker it waits on has died."""
+        try:
+            for index, frames in enumerate(self.inputs):
+                idle = 0
+                while not frames.put(b''):
+                    self.collect()
+                    self.check_worker(index)
+                    idle = backoff(idle)
+            for process in self.processes:
+                process.join()
+        finally:
+            # after a failure the other workers may never see their stop frame
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            for ring in self.inputs + self.outputs:
+                ring.close()
+            self.wake_reader.close()
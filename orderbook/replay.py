@@ -0,0 +1,164 @@
+import argparse
+from itertools import islice
+import time
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from orderbook.book import Book
+from orderbook.capture import read_capture
+from instrumentation.histogram import Histogram
+from orderbook.timestamps import parse_time_ns
+
+
+def load_records(path):
+    """Yield (timestamp in epoch ns, message) from a binary capture or a messages.json list.
+
+    Captures are timed by local receive time, JSON lists by the exchange timestamp.
+    """
+    if path.endswith('.json'):
+        with open(path) as messages_json_file:
+            messages = json.load(messages_json_file)
+        for message in messages:
+            yield parse_time_ns(message['time']), message
+    else:
+        for receive_time, frame in read_capture(path):
+            message = json.loads(frame)
+            if 'sequence' in message:
+                yield receive_time, message
+
+
+def compare_to_snapshot(book, level3, limit=10):
+    """Return up to limit differences between book and a level 3 snapshot, empty when they agree.
+
+    Besides the orders at each price, each level's aggregate size and count and the order of the
+    better/worse ladder are checked, as they are kept incrementally rather than derived.
+    """
+    control = Book(fixed_point=book.fixed_point, price_places=book.price_places)
+    control.get_level3(level3)
+    differences = []
+    for name in ('bids', 'asks'):
+        tree = getattr(book, name)
+        control_tree = getattr(control, name)
+        for price in set(tree.price_map) ^ set(control_tree.price_map):
+            differences.append('{0}: price level {1} only on one side'.format(name, price))
+        for price in set(tree.price_map) & set(control_tree.price_map):
+            orders = [(order.order_id, order.size) for order in tree.price_map[price]]
+            control_orders = [(order.order_id, order.size) for order in control_tree.price_map[price]]
+            if orders != control_orders:
+                differences.append('{0}: orders at {1} differ'.format(name, price))
+        # the level aggregates and ladder links are kept incrementally, so check them against the orders
+        for price, level in tree.price_map.items():
+            orders = list(islice(level, len(tree.order_map) + 1))
+            if level.count != len(orders) or level.size != sum(order.size for order in orders):
+                differences.append('{0}: level {1} holds {2} orders of {3} but its orders sum to {4} of {5}'.format(
+                    name, price, level.count, level.size, len(orders), sum(order.size for order in orders)))
+        # a broken link could make a cycle, so never walk further than there are levels
+        ladder = list(islice(tree.iter_levels(), len(tree.price_map) + 1))
+        if [level.price for level in ladder] != sorted(control_tree.price_map, reverse=tree.is_bid):
+            differences.append('{0}: price ladder is not in the snapshot\'s price order'.format(name))
+        elif (ladder and ladder[0].better is not None) or \
+                any(worse.better is not better for better, worse in zip(ladder, ladder[1:])):
+            differences.append('{0}: better links do not mirror the worse links'.format(name))
+        if len(differences) >= limit:
+            break
+    return differences[:limit]
+
+
+class Replay(object):
+    """Feeds recorded messages into a Book and measures how fast it applies them.
+
+    speed None replays as fast as possible, 1.0 in real time and N at N times real time.
+    checkpoints maps a sequence number to the level 3 snapshot the book must match once that
+    sequence has been applied; checkpoints the records never reach are reported as failed.
+    """
+
+    def __init__(self, book, records, speed=None, checkpoints=None):
+        self.book = book
+        self.records = records
+        self.speed = speed
+        self.checkpoints = dict(checkpoints or {})
+        self.latencies = Histogram()
+        self.checkpoint_results = []
+        self.messages = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        book = self.book
+        process_message = book.process_message
+        record_latency = self.latencies.record
+        checkpoints = self.checkpoints
+        speed = self.speed
+        clock = time.perf_counter_ns
+        first_timestamp = None
+        start = time.perf_counter()
+        for timestamp, message in self.records:
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = (timestamp - first_timestamp) / 1e9 / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            before = clock()
+            if not process_message(message):
+                raise ValueError('book rejected message {0}'.format(message.get('sequence')))
+            record_latency(clock() - before)
+            self.messages += 1
+            if checkpoints and book.last_sequence in checkpoints:
+                differences = compare_to_snapshot(book, checkpoints.pop(book.last_sequence))
+                self.checkpoint_results.append((book.last_sequence, differences))
+        self.elapsed = time.perf_counter() - start
+        # a checkpoint the recording never reaches has not been checked, so it counts as failed
+        for sequence in sorted(checkpoints):
+            self.checkpoint_results.append(
+                (sequence, ['sequence {0} never reached, replay ended at {1}'.format(sequence, book.last_sequence)]))
+        checkpoints.clear()
+        return self.report()
+
+    @property
+    def consistent(self):
+        return not any(differences for sequence, differences in self.checkpoint_results)
+
+    def report(self):
+        return {
+            'messages': self.messages,
+            'seconds': self.elapsed,
+            # wall clock rate, including pacing and decoding the records
+            'messages_per_sec': self.messages / self.elapsed if self.elapsed else 0.0,
+            # rate of process_message alone
+            'applied_per_sec': self.messages / (self.latencies.total / 1e9) if self.latencies.total else 0.0,
+            'latency_ns': self.latencies.summary(),
+            'checkpoints': [{'sequence': sequence, 'differences': differences}
+                            for sequence, differences in self.checkpoint_results],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded feed into an order book.')
+    parser.add_argument('messages', help='capture file or messages.json')
+    parser.add_argument('--begin', required=True, help='level 3 snapshot the recording starts from')
+    parser.add_argument('--end', action='append', default=[], help='level 3 snapshot to check against')
+    parser.add_argument('--speed', type=float, default=None, help='1 for real time, N for N times, default max')
+    parser.add_argument('--fixed-point', action='store_true', default=False)
+    args = parser.parse_args()
+
+    book = Book(fixed_point=args.fixed_point)
+    with open(args.begin) as begin_file:
+        book.get_level3(json.load(begin_file))
+    checkpoints = {}
+    for path in args.end:
+        with open(path) as end_file:
+            level3 = json.load(end_file)
+        checkpoints[level3['sequence']] = level3
+
+    replay = Replay(book, load_records(args.messages), speed=args.speed, checkpoints=checkpoints)
+    report = replay.run()
+    print(json.dumps(report, indent=4, sort_keys=True))
+    if not replay.consistent:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
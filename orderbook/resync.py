@@ -0,0 +1,106 @@
+import asyncio
+from time import perf_counter_ns
+
+from instrumentation.probes import probes
+from orderbook.book import Book
+from orderbook import file_logger
+
+
+class BookSynchronizer(object):
+    """Keeps a Book consistent with the feed, recovering from sequence gaps without reconnecting.
+
+    On a gap the feed keeps being read and its messages are buffered while a fresh level 3 snapshot is
+    fetched and loaded into a new Book on a worker thread. The buffered messages after the snapshot
+    sequence are then applied to the new book, which book adopts in one step. Buffered matches the
+    snapshot already covers are still added to the trade tape, so only the trades in the gap itself, never
+    received, are missing from it. The time from the gap to a consistent book is recorded as the resync
+    latency probe.
+
+    fetch, if given, returns the snapshot document; otherwise the snapshot is streamed from the exchange.
+    """
+
+    def __init__(self, book, fetch=None, retry_delay=1.0, loop=None):
+        self.book = book
+        self.fetch = fetch
+        self.retry_delay = retry_delay
+        self.loop = loop
+        # feed messages received while resyncing, None when the book is live
+        self.buffer = None
+        self.loading = False
+        self.started = 0
+        self.resyncs = 0
+
+    @property
+    def resyncing(self):
+        return self.buffer is not None
+
+    def start(self):
+        """Rebuild the book from a new snapshot, buffering feed messages until it has loaded.
+
+        Also called after a reconnect, when anything already buffered came from the old connection.
+        """
+        if self.buffer is None:
+            self.started = perf_counter_ns()
+        self.buffer = []
+        if not self.loading:
+            self.load()
+
+    def load(self):
+        self.loading = True
+        loop = self.loop or asyncio.get_event_loop()
+        future = loop.run_in_executor(None, self.load_snapshot)
+        future.add_done_callback(self.loaded)
+
+    def load_snapshot(self):
+        book = Book(product_id=self.book.product_id, fixed_point=self.book.fixed_point,
+                    normalized=self.book.normalized, price_places=self.book.price_places)
+        book.get_level3(self.fetch() if self.fetch is not None else None)
+        return book
+
+    def loaded(self, future):
+        self.loading = False
+        try:
+            book = future.result()
+        except Exception:
+            file_logger.exception('level 3 snapshot failed, retrying in %s seconds', self.retry_delay)
+            self.loading = True
+            (self.loop or asyncio.get_event_loop()).call_later(self.retry_delay, self.load)
+            return
+        last_sequence = self.book.last_sequence
+        for message in self.buffer:
+            if message['type'] == 'match' and last_sequence < message['sequence'] <= book.level3_sequence:
+                # the snapshot already holds its effect on the book, but the trade still belongs on the tape
+                book.record_trade(message)
+                continue
+            if book.process_message(message):
+                continue
+            if book.gap_count:
+                # the snapshot is older than the buffer or the feed gapped again, so fetch another one, after
+                # retry_delay since the snapshot often lags the feed and the endpoint is rate limited. The
+                # whole buffer is kept, the next snapshot's book and tape start over from it
+                self.loading = True
+                (self.loop or asyncio.get_event_loop()).call_later(self.retry_delay, self.load)
+                return
+            file_logger.error('buffered message not applied: %s', message)
+        self.book.adopt(book)
+        self.buffer = None
+        self.resyncs += 1
+        probes.since('resync', self.started)
+
+    def process_message(self, message):
+        """Apply message to the book, or buffer it while resyncing. Returns False only for unhandled messages."""
+        if self.buffer is not None:
+            self.buffer.append(message)
+            return True
+        gaps = self.book.gap_count
+        if self.book.process_message(message):
+            return True
+        if self.book.gap_count == gaps:
+            return False
+        self.start()
+        self.buffer.append(message)
+        return True
+
+    def stats(self):
+        return {'resyncing': self.resyncing, 'resyncs': self.resyncs,
+                'buffered': len(self.buffer) if self.buffer is not None else 0}
@@ -0,0 +1,76 @@
+# Single producer, single consumer byte ring in shared memory. The header holds two monotonic byte
+# counters, written (by the producer) and read (by the consumer), each only ever stored by its owner
+# and only after the data it covers, so neither side needs a lock. The counters are aligned native
+# 64 bit words accessed through a memoryview cast, so each load and store is a single instruction and
+# can never be seen half written. Records are a little-endian length followed by the payload; a record
+# that would run past the end of the buffer is preceded by WRAP and starts again at offset 0.
+import struct
+from multiprocessing import shared_memory
+
+LENGTH = struct.Struct('<I')
+HEADER_SIZE = 64
+WRITTEN = 0
+READ = 1
+WRAP = 0xFFFFFFFF
+
+
+class RingBuffer(object):
+    def __init__(self, capacity=1 << 22, name=None):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity)
+            self.memory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+            self.owner = True
+        else:
+            # processes started by the creator share its resource tracker, so attaching registers nothing new
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.memory.name
+        self.capacity = capacity
+        self.counters = self.memory.buf[:16].cast('Q')
+        self.data = self.memory.buf[HEADER_SIZE:HEADER_SIZE + self.capacity]
+        # each side's own counter, kept locally so only the other side's needs reading from the header
+        self.written = self.counters[WRITTEN]
+        self.read = self.counters[READ]
+
+    def put(self, payload):
+        """Append payload, returning False without writing anything when the ring is too full."""
+        size = LENGTH.size + len(payload)
+        if size > self.capacity // 2:
+            raise ValueError('record of {0} bytes does not fit a ring of {1}'.format(len(payload), self.capacity))
+        written = self.written
+        position = written % self.capacity
+        skip = self.capacity - position if self.capacity - position < size else 0
+        if written + skip + size - self.counters[READ] > self.capacity:
+            return False
+        if skip:
+            if skip >= LENGTH.size:
+                LENGTH.pack_into(self.data, position, WRAP)
+            written += skip
+            position = 0
+        LENGTH.pack_into(self.data, position, len(payload))
+        self.data[position + LENGTH.size:position + size] = payload
+        self.written = self.counters[WRITTEN] = written + size
+        return True
+
+    def get(self):
+        """Return the next payload as bytes, or None when the ring is empty."""
+        read = self.read
+        if read == self.counters[WRITTEN]:
+            return None
+        position = read % self.capacity
+        remaining = self.capacity - position
+        if remaining < LENGTH.size or LENGTH.unpack_from(self.data, position)[0] == WRAP:
+            read += remaining
+            position = 0
+        length = LENGTH.unpack_from(self.data, position)[0]
+        start = position + LENGTH.size
+        payload = bytes(self.data[start:start + length])
+        self.read = self.counters[READ] = read + LENGTH.size + length
+        return payload
+
+    def close(self):
+        self.data.release()
+        self.counters.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
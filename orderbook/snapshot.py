@@ -0,0 +1,41 @@
+import codecs
+import re
+
+# an order entry, a bids or asks key, or the sequence number once the delimiter after it has arrived
+TOKEN = re.compile(r'\[\s*"([^"]*)"\s*,\s*"([^"]*)"\s*,\s*"([^"]*)"\s*\]|"(bids|asks)"\s*:|"sequence"\s*:\s*(\d+)\s*[,}]')
+# longest tail kept when a chunk ends inside a token, comfortably more than one order entry
+MAX_PARTIAL = 512
+
+
+class SnapshotParser(object):
+    """Parses a level 3 snapshot document incrementally, as its chunks arrive.
+
+    parse() yields (side, price, size, order_id) strings for each order as soon as its entry is complete,
+    side being 'bids' or 'asks', without ever holding the whole document. The sequence is set once seen.
+    """
+
+    def __init__(self):
+        self.sequence = None
+        self.side = None
+
+    def parse(self, chunks):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        finditer = TOKEN.finditer
+        buffer = ''
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            buffer += chunk
+            end = 0
+            for match in finditer(buffer):
+                price, size, order_id, side, sequence = match.groups()
+                if price is not None:
+                    yield self.side, price, size, order_id
+                elif side is not None:
+                    self.side = side
+                else:
+                    self.sequence = int(sequence)
+                end = match.end()
+            buffer = buffer[max(end, len(buffer) - MAX_PARTIAL):]
+        if self.sequence is None:
+            raise ValueError('level 3 snapshot has no sequence')
@@ -0,0 +1,77 @@
+from collections import deque
+
+from instrumentation.histogram import Histogram
+
+
+class RollingStats(object):
+    """Inter-arrival statistics over a sliding time window, updated in O(1) amortized time per sample.
+
+    Mean comes from the window's span, min and max from monotonic deques, and percentiles from a
+    Histogram that samples are recorded into and removed from again when they leave the window.
+    """
+
+    def __init__(self, window=60 * 10 ** 9, unit=1000):
+        # window in the timestamps' unit (nanoseconds by default), gaps reported in units of unit (microseconds)
+        self.window = window
+        self.unit = unit
+        self.times = deque()
+        self.gaps = deque()
+        self.gap_count = 0
+        self.minimums = deque()
+        self.maximums = deque()
+        self.histogram = Histogram()
+
+    def add(self, timestamp):
+        times = self.times
+        if times:
+            gap = max(timestamp - times[-1], 0) // self.unit
+            index = self.gap_count
+            self.gap_count += 1
+            self.gaps.append(gap)
+            minimums = self.minimums
+            while minimums and minimums[-1][1] >= gap:
+                minimums.pop()
+            minimums.append((index, gap))
+            maximums = self.maximums
+            while maximums and maximums[-1][1] <= gap:
+                maximums.pop()
+            maximums.append((index, gap))
+            self.histogram.record(gap)
+        times.append(timestamp)
+
+        oldest = timestamp - self.window
+        while times[0] < oldest:
+            times.popleft()
+            self.evict_gap()
+
+    def evict_gap(self):
+        gap = self.gaps.popleft()
+        index = self.gap_count - len(self.gaps) - 1
+        if self.minimums[0][0] == index:
+            self.minimums.popleft()
+        if self.maximums[0][0] == index:
+            self.maximums.popleft()
+        self.histogram.remove(gap)
+
+    def __len__(self):
+        return len(self.gaps)
+
+    @property
+    def mean(self):
+        if not self.gaps:
+            return 0.0
+        return (self.times[-1] - self.times[0]) / self.unit / len(self.gaps)
+
+    @property
+    def minimum(self):
+        return self.minimums[0][1] if self.minimums else 0
+
+    @property
+    def maximum(self):
+        return self.maximums[0][1] if self.maximums else 0
+
+    def percentile(self, percent):
+        """The given percentile of the gaps in the window, to within 12.5%."""
+        if not self.gaps:
+            return 0
+        return min(self.histogram.percentile(percent), self.maximum)
@@ -0,0 +1,163 @@
+import random
+import uuid
+from datetime import datetime, timedelta
+
+
+class SyntheticFeed(object):
+    """Generates a realistic full channel message stream together with matching level 3 snapshots.
+
+    orders resting orders are spread over levels price levels per side, with spread ticks between the
+    best bid and best ask. Each event is a cancel, match or change with the given ratios, otherwise a
+    new limit order. Everything is derived from seed, so the same parameters give the same feed.
+    """
+
+    def __init__(self, orders=2000, levels=300, spread=1, cancel_ratio=0.4, match_ratio=0.1, change_ratio=0.05,
+                 mid_price=650000, seed=1, product_id='BTC-USD'):
+        self.product_id = product_id
+        self.levels = levels
+        self.spread = spread
+        self.cancel_ratio = cancel_ratio
+        self.match_ratio = match_ratio
+        self.change_ratio = change_ratio
+        self.mid_price = mid_price
+        self.random = random.Random(seed)
+
+        # price in ticks -> FIFO list of [order_id, size in satoshis]
+        self.book = {'buy': {}, 'sell': {}}
+        self.orders = {}
+        self.order_ids = []
+        self.sequence = 1000
+        self.time = datetime(2015, 1, 1)
+        for _ in range(orders):
+            side = self.random.choice(('buy', 'sell'))
+            self.add_order(side, self.new_order_id(), self.random_price(side), self.random_size())
+
+    @staticmethod
+    def format_price(ticks):
+        return '{0}.{1:02d}'.format(ticks // 100, ticks % 100)
+
+    @staticmethod
+    def format_size(units):
+        return '{0}.{1:08d}'.format(units // 100000000, units % 100000000)
+
+    def new_order_id(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def random_price(self, side):
+        offset = self.random.randint(0, self.levels - 1)
+        return self.mid_price - offset if side == 'buy' else self.mid_price + self.spread + offset
+
+    def random_size(self):
+        return self.random.randint(1, 500) * 1000000
+
+    def add_order(self, side, order_id, price, size):
+        self.book[side].setdefault(price, []).append([order_id, size])
+        self.orders[order_id] = (side, price, len(self.order_ids))
+        self.order_ids.append(order_id)
+
+    def drop_order(self, order_id):
+        side, price, index = self.orders.pop(order_id)
+        # swap remove keeps random cancel selection O(1)
+        last = self.order_ids.pop()
+        if last != order_id:
+            self.order_ids[index] = last
+            last_side, last_price, _ = self.orders[last]
+            self.orders[last] = (last_side, last_price, index)
+        level = self.book[side][price]
+        for position, (resting_id, size) in enumerate(level):
+            if resting_id == order_id:
+                del level[position]
+                break
+        if not level:
+            del self.book[side][price]
+        return side, price, size
+
+    def snapshot(self):
+        return {'sequence': self.sequence,
+                'bids': [[self.format_price(price), self.format_size(size), order_id]
+                         for price in sorted(self.book['buy'], reverse=True)
+                         for order_id, size in self.book['buy'][price]],
+                'asks': [[self.format_price(price), self.format_size(size), order_id]
+                         for price in sorted(self.book['sell'])
+                         for order_id, size in self.book['sell'][price]]}
+
+    def message(self, message_type, side, **fields):
+        self.sequence += 1
+        self.time += timedelta(microseconds=self.random.randint(0, 10000))
+        fields.update({'type': message_type, 'side': side, 'sequence': self.sequence, 'product_id': self.product_id,
+                       'time': self.time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')})
+        return fields
+
+    def messages(self, count):
+        """Yield at least count messages, finishing the event in progress."""
+        produced = 0
+        while produced < count:
+            for message in self.event():
+                produced += 1
+                yield message
+
+    def event(self):
+        draw = self.random.random()
+        if draw < self.cancel_ratio and self.order_ids:
+            return self.cancel()
+        draw -= self.cancel_ratio
+        if draw < self.match_ratio and self.order_ids:
+            return self.match()
+        draw -= self.match_ratio
+        if draw < self.change_ratio and self.order_ids:
+            return self.change()
+        return self.new_order()
+
+    def new_order(self):
+        side = self.random.choice(('buy', 'sell'))
+        order_id = self.new_order_id()
+        price = self.random_price(side)
+        size = self.random_size()
+        messages = [self.message('received', side, order_id=order_id, size=self.format_size(size),
+                                 price=self.format_price(price), order_type='limit'),
+                    self.message('open', side, order_id=order_id, remaining_size=self.format_size(size),
+                                 price=self.format_price(price))]
+        self.add_order(side, order_id, price, size)
+        return messages
+
+    def cancel(self):
+        order_id = self.random.choice(self.order_ids)
+        side, price, size = self.drop_order(order_id)
+        return [self.message('done', side, order_id=order_id, price=self.format_price(price),
+                             remaining_size=self.format_size(size), reason='canceled')]
+
+    def match(self):
+        side = self.random.choice(('buy', 'sell'))
+        if not self.book[side]:
+            return self.new_order()
+        price = max(self.book[side]) if side == 'buy' else min(self.book[side])
+        maker = self.book[side][price][0]
+        taker_id = self.new_order_id()
+        taker_side = 'sell' if side == 'buy' else 'buy'
+        size = self.random.randint(1, maker[1] // 1000000) * 1000000
+        messages = [self.message('received', taker_side, order_id=taker_id, size=self.format_size(size),
+                                 price=self.format_price(price), order_type='limit'),
+                    self.message('match', side, maker_order_id=maker[0], taker_order_id=taker_id,
+                                 size=self.format_size(size), price=self.format_price(price),
+                                 trade_id=self.sequence)]
+        maker[1] -= size
+        if not maker[1]:
+            self.drop_order(maker[0])
+            messages.append(self.message('done', side, order_id=maker[0], price=self.format_price(price),
+                                         remaining_size=self.format_size(0), reason='filled'))
+        messages.append(self.message('done', taker_side, order_id=taker_id, price=self.format_price(price),
+                                     remaining_size=self.format_size(0), reason='filled'))
+        return messages
+
+    def change(self):
+        order_id = self.random.choice(self.order_ids)
+        side, price, _ = self.orders[order_id]
+        for order in self.book[side][price]:
+            if order[0] == order_id:
+                if order[1] <= 1000000:
+                    return self.cancel()
+                new_size = order[1] - 1000000
+                message = self.message('change', side, order_id=order_id, new_size=self.format_size(new_size),
+                                       old_size=self.format_size(order[1]), price=self.format_price(price))
+                order[1] = new_size
+                return [message]
@@ -0,0 +1,231 @@
+# Columnar store of the trades seen on the feed. Each column is an integer array: exchange time in epoch
+# nanoseconds, the maker's side (1 buy, -1 sell), and price and size as fixed point ints, whatever mode
+# the book runs in, so the tape holds the feed's values exactly. Trades are also rolled into time
+# bucketed OHLCV bars and a rolling VWAP, in batches, so each trade is aggregated once and nothing ever
+# rescans the tape.
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import mul
+import struct
+
+SECOND = 1000000000
+MINUTE = 60 * SECOND
+# a spill chunk is its trade count followed by the four columns
+SPILL_HEADER = struct.Struct('<Q')
+
+
+class BarSeries(object):
+    """OHLCV bars of one interval: closed bars in columns, at most capacity of them, plus the open bar."""
+
+    def __init__(self, interval, capacity):
+        self.interval = interval
+        self.capacity = capacity
+        self.starts = array('q')
+        self.opens = array('q')
+        self.highs = array('q')
+        self.lows = array('q')
+        self.closes = array('q')
+        self.volumes = array('q')
+        # price times size as doubles, the fixed point products overflow int64 within a busy minute
+        self.notionals = array('d')
+        self.counts = array('q')
+        # the open bar, with no trades until the first extend
+        self.start = self.end = 0
+        self.open = self.high = self.low = self.close = None
+        self.volume = 0
+        self.notional = 0
+        self.count = 0
+
+    def extend(self, times, prices, sizes):
+        """Fold in trades given as column slices in time order, a whole bucket at a time."""
+        index = 0
+        count = len(times)
+        while index < count:
+            time_ns = times[index]
+            if not self.start <= time_ns < self.end:
+                self.open_bar(time_ns, prices[index])
+            end = bisect_left(times, self.end, index)
+            bar_prices = prices[index:end]
+            bar_sizes = sizes[index:end]
+            self.high = max(self.high, max(bar_prices))
+            self.low = min(self.low, min(bar_prices))
+            self.close = bar_prices[-1]
+            self.volume += sum(bar_sizes)
+            self.notional += sum(map(mul, bar_prices, bar_sizes))
+            self.count += end - index
+            index = end
+
+    def open_bar(self, time_ns, price):
+        if self.count:
+            self.roll()
+        self.start = time_ns - time_ns % self.interval
+        self.end = self.start + self.interval
+        self.open = self.high = self.low = price
+        self.volume = 0
+        self.notional = 0
+        self.count = 0
+
+    def roll(self):
+        self.starts.append(self.start)
+        self.opens.append(self.open)
+        self.highs.append(self.high)
+        self.lows.append(self.low)
+        self.closes.append(self.close)
+        self.volumes.append(self.volume)
+        self.notionals.append(float(self.notional))
+        self.counts.append(self.count)
+        # trimmed in blocks so the memmove is amortized over many bars
+        if len(self.starts) >= 2 * self.capacity:
+            for column in (self.starts, self.opens, self.highs, self.lows, self.closes, self.volumes,
+                           self.notionals, self.counts):
+                del column[:len(column) - self.capacity]
+
+    def __len__(self):
+        return min(len(self.starts), self.capacity) + (self.count > 0)
+
+    def ohlcv(self, count=None):
+        """The last count bars, oldest first, as (start, open, high, low, close, volume, vwap, trades).
+
+        The last bar is the one still open.
+        """
+        closed = min(len(self.starts), self.capacity)
+        wanted = closed if count is None else min(closed, max(count - (self.count > 0), 0))
+        bars = [(self.starts[index], self.opens[index], self.highs[index], self.lows[index], self.closes[index],
+                 self.volumes[index], self.notionals[index] / float(self.volumes[index]), self.counts[index])
+                for index in range(len(self.starts) - wanted, len(self.starts))]
+        if self.count and count != 0:
+            bars.append((self.start, self.open, self.high, self.low, self.close, self.volume,
+                         self.notional / float(self.volume) if self.volume else None, self.count))
+        return bars
+
+
+class TradeTape(object):
+    """Trades in array columns with incremental bars and a rolling VWAP.
+
+    add only appends to the columns, so the match handler stays cheap; trades are folded into the bars
+    and the VWAP window in batches when either is read, or before they are trimmed, each trade once. Trade
+    times are taken to never go backwards, as on the feed. At most capacity trades are kept, except that
+    trades inside the VWAP window are never dropped. Older trades are trimmed in blocks and, with
+    spill_path, appended to that file first, see read_spill. Prices are ticks of the book's price places
+    and sizes units of SIZE_PLACES, as for a fixed point Book.
+    """
+
+    def __init__(self, capacity=100000, vwap_window=MINUTE, intervals=(SECOND, MINUTE), bar_capacity=3600,
+                 spill_path=None):
+        self.capacity = capacity
+        self.times = array('q')
+        self.sides = array('b')
+        self.prices = array('q')
+        self.sizes = array('q')
+        self.bars = {interval: BarSeries(interval, bar_capacity) for interval in intervals}
+        self.vwap_window = vwap_window
+        # index of the first trade not yet in the bars and window sums
+        self.folded = 0
+        # index of the oldest trade in the VWAP window, and the window's sums, as exact ints
+        self.window_start = 0
+        self.window_volume = 0
+        self.window_notional = 0
+        self.spill_path = spill_path
+        self.spilled = 0
+        # trades ever added, trimmed or not
+        self.total = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, time_ns, side, price, size):
+        self.times.append(time_ns)
+        self.sides.append(side)
+        self.prices.append(price)
+        self.sizes.append(size)
+        self.total += 1
+        if len(self.times) >= 2 * self.capacity:
+            self.trim()
+
+    def fold(self):
+        """Bring the bars and the VWAP window up to date with the trades added since the last fold."""
+        start = self.folded
+        end = len(self.times)
+        if start == end:
+            return
+        times = self.times[start:]
+        prices = self.prices[start:]
+        sizes = self.sizes[start:]
+        for bars in self.bars.values():
+            bars.extend(times, prices, sizes)
+        self.window_volume += sum(sizes)
+        self.window_notional += sum(map(mul, prices, sizes))
+        self.folded = end
+        cutoff = times[-1] - self.vwap_window
+        window_start = bisect_right(self.times, cutoff, self.window_start, end)
+        if window_start == end:
+            # an empty window, start the sums afresh
+            self.window_volume = 0
+            self.window_notional = 0
+        elif window_start > self.window_start:
+            prices = self.prices[self.window_start:window_start]
+            sizes = self.sizes[self.window_start:window_start]
+            self.window_volume -= sum(sizes)
+            self.window_notional -= sum(map(mul, prices, sizes))
+        self.window_start = window_start
+
+    def trim(self):
+        self.fold()
+        drop = min(len(self.times) - self.capacity, self.window_start)
+        if drop <= 0:
+            return
+        if self.spill_path is not None:
+            with open(self.spill_path, 'ab') as spill_file:
+                spill_file.write(SPILL_HEADER.pack(drop))
+                for column in (self.times, self.sides, self.prices, self.sizes):
+                    column[:drop].tofile(spill_file)
+            self.spilled += drop
+        for column in (self.times, self.sides, self.prices, self.sizes):
+            del column[:drop]
+        self.window_start -= drop
+        self.folded -= drop
+
+    def extend(self, other):
+        """Add the trades of other, a tape whose trades all follow this one's."""
+        for trade in zip(other.times, other.sides, other.prices, other.sizes):
+            self.add(*trade)
+
+    @property
+    def vwap(self):
+        """Volume weighted average price over the trades of the last vwap_window nanoseconds, or None.
+
+        In ticks, like the prices, but as a float.
+        """
+        self.fold()
+        if self.window_volume <= 0:
+            return None
+        return self.window_notional / float(self.window_volume)
+
+    @property
+    def window_trades(self):
+        self.fold()
+        return len(self.times) - self.window_start
+
+    def ohlcv(self, interval=SECOND, count=None):
+        """The last count bars of interval, see BarSeries.ohlcv."""
+        self.fold()
+        return self.bars[interval].ohlcv(count)
+
+    def last(self, count):
+        """The last count trades, newest first, as (time_ns, side, price, size)."""
+        start = max(len(self.times) - count, 0)
+        return list(zip(*(column[start:][::-1] for column in (self.times, self.sides, self.prices, self.sizes))))
+
+
+def read_spill(path):
+    """Yield the trades spilled to path, oldest first, as (time_ns, side, price, size)."""
+    with open(path, 'rb') as spill_file:
+        while True:
+            header = spill_file.read(SPILL_HEADER.size)
+            if not header:
+                return
+            count = SPILL_HEADER.unpack(header)[0]
+            columns = [array(type_code) for type_code in ('q', 'b', 'q', 'q')]
+            for column in columns:
+                column.fromfile(spill_file, count)
+            yield from zip(*columns)
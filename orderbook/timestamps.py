@@ -0,0 +1,28 @@
+from datetime import date, datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def parse_time(value):
+    """Parse a feed timestamp of the fixed form '%Y-%m-%dT%H:%M:%S.%fZ' into an aware UTC datetime.
+
+    Slices the fixed-width fields instead of going through dateutil's generic parser.
+    """
+    fraction = value[20:-1]
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    int((fraction + '000000')[:6]) if fraction else 0, timezone.utc)
+
+
+def parse_time_ns(value):
+    """Parse a feed timestamp into integer nanoseconds since the epoch."""
+    days = date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - EPOCH_ORDINAL
+    seconds = ((days * 24 + int(value[11:13])) * 60 + int(value[14:16])) * 60 + int(value[17:19])
+    fraction = value[20:-1]
+    return seconds * 1000000000 + (int((fraction + '000000000')[:9]) if fraction else 0)
+
+
+def datetime_from_ns(value):
+    """The aware UTC datetime of integer epoch nanoseconds, truncated to microseconds like parse_time."""
+    return EPOCH + timedelta(microseconds=value // 1000)
@@ -1,50 +1,275 @@
-from bintrees import FastRBTree
+from itertools import islice
+
+from bintrees import FastRBTree, RBTree
+from bintrees.rbtree import Node as RBNode
+
+
+class Order(object):
+    """A resting order, linked into the FIFO queue of its price level."""
+    __slots__ = ('order_id', 'size', 'price', 'level', 'prev', 'next')
+
+    def __init__(self, order_id, size, price, level):
+        self.order_id = order_id
+        self.size = size
+        self.price = price
+        self.level = level
+        self.prev = None
+        self.next = None
+
+
+class PriceLevel(object):
+    """Doubly linked FIFO queue of the orders resting at one price.
+
+    Keeps the aggregate size and order count of the level up to date so
+    they never have to be summed from the orders. Levels are also linked
+    to their neighbours on the same side, better being the next price
+    towards the top of book and worse the next one away from it, so depth
+    can be walked without going through the price index.
+    """
+    __slots__ = ('price', 'head', 'tail', 'count', 'size', 'better', 'worse')
+
+    def __init__(self, price):
+        self.price = price
+        self.head = None
+        self.tail = None
+        self.count = 0
+        self.size = 0
+        self.better = None
+        self.worse = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        order = self.head
+        while order is not None:
+            yield order
+            order = order.next
+
+    def append(self, order):
+        order.prev = self.tail
+        order.next = None
+        if self.tail is None:
+            self.head = order
+        else:
+            self.tail.next = order
+        self.tail = order
+        self.count += 1
+        self.size += order.size
+
+    def remove(self, order):
+        prev_order = order.prev
+        next_order = order.next
+        if prev_order is None:
+            self.head = next_order
+        else:
+            prev_order.next = next_order
+        if next_order is None:
+            self.tail = prev_order
+        else:
+            next_order.prev = prev_order
+        order.prev = order.next = None
+        self.count -= 1
+        self.size -= order.size
+
+
+def build_price_tree(levels):
+    """Build the price index over levels, PriceLevels in ascending price order, in linear time.
+
+    The nodes are linked directly into a balanced tree: every node is black except those on the deepest
+    row, which are red so that all paths carry the same number of black nodes. When FastRBTree is the
+    compiled implementation its nodes are out of reach and the levels are inserted one by one instead.
+    """
+    price_tree = FastRBTree()
+    if type(price_tree) is not RBTree:
+        for level in levels:
+            price_tree.insert(level.price, level)
+        return price_tree
+    red_depth = len(levels).bit_length() - 1
+
+    def build(low, high, depth):
+        if low >= high:
+            return None
+        middle = (low + high) // 2
+        level = levels[middle]
+        node = RBNode(level.price, level)
+        node.red = 0 < depth == red_depth
+        node.left = build(low, middle, depth + 1)
+        node.right = build(middle + 1, high, depth + 1)
+        return node
+
+    price_tree._root = build(0, len(levels), 0)
+    price_tree._count = len(levels)
+    return price_tree
 
 
 class Tree(object):
-    def __init__(self):
+    def __init__(self, is_bid=False):
         self.price_tree = FastRBTree()
         self.price_map = {}
         self.order_map = {}
         self.received_orders = {}
 
+        # top of book cache: the best level is the highest price for bids and the lowest for asks
+        self.is_bid = is_bid
+        self.best_price = None
+        self.best_level = None
+        self.top_version = 0
+        # called with no arguments whenever the top of book changes
+        self.listener = None
+
+    @classmethod
+    def from_snapshot(cls, orders, is_bid=False):
+        tree = cls(is_bid=is_bid)
+        tree.load_orders(orders)
+        return tree
+
+    @property
+    def best_size(self):
+        return self.best_level.size if self.best_level is not None else None
+
+    def top_changed(self):
+        self.top_version += 1
+        if self.listener is not None:
+            self.listener()
+
+    def reset_best(self):
+        if self.price_tree.is_empty():
+            self.best_price = None
+            self.best_level = None
+        else:
+            self.best_price, self.best_level = self.price_tree.max_item() if self.is_bid else self.price_tree.min_item()
+        self.top_changed()
+
     def receive(self, order_id, size):
         self.received_orders[order_id] = size
 
     def create_price(self, price):
-        new_list = []
-        self.price_tree.insert(price, new_list)
-        self.price_map[price] = new_list
+        level = PriceLevel(price)
+        self.price_tree.insert(price, level)
+        self.price_map[price] = level
+        best_price = self.best_price
+        if best_price is None or (price > best_price if self.is_bid else price < best_price):
+            level.worse = self.best_level
+            if level.worse is not None:
+                level.worse.better = level
+            self.best_price = price
+            self.best_level = level
+        else:
+            better = (self.price_tree.succ_item(price) if self.is_bid else self.price_tree.prev_item(price))[1]
+            level.better = better
+            level.worse = better.worse
+            better.worse = level
+            if level.worse is not None:
+                level.worse.better = level
+        return level
 
     def remove_price(self, price):
         self.price_tree.remove(price)
-        del self.price_map[price]
+        level = self.price_map.pop(price)
+        if level.better is not None:
+            level.better.worse = level.worse
+        if level.worse is not None:
+            level.worse.better = level.better
+        if level is self.best_level:
+            self.best_level = level.worse
+            self.best_price = level.worse.price if level.worse is not None else None
+            self.top_changed()
+
+    def level(self, price):
+        """The PriceLevel at price, with its aggregate size and order count, or None."""
+        return self.price_map.get(price)
+
+    def iter_levels(self):
+        """Yield the price levels from the top of book outwards."""
+        level = self.best_level
+        while level is not None:
+            yield level
+            level = level.worse
+
+    def top_levels(self, count):
+        return list(islice(self.iter_levels(), count))
 
     def insert_order(self, order_id, size, price, initial=False):
         if not initial:
             del self.received_orders[order_id]
-        if price not in self.price_map:
-            self.create_price(price)
-        order = {'order_id': order_id, 'size': size, 'price': price, 'price_map': self.price_map[price]}
-        self.price_map[price].append(order)
+        level = self.price_map.get(price)
+        if level is None:
+            level = self.create_price(price)
+        order = Order(order_id, size, price, level)
+        level.append(order)
         self.order_map[order_id] = order
+        if level is self.best_level:
+            self.top_changed()
+
+    def load_orders(self, orders):
+        """Add resting orders from a snapshot, as (price, size, order_id) in price then queue order.
+
+        Orders at one price arrive together, so the price index is only touched once per level, and an
+        empty tree has its whole index built in one linear pass.
+        """
+        if not self.price_map:
+            return self.bulk_load(orders)
+        price_map = self.price_map
+        order_map = self.order_map
+        level = None
+        for price, size, order_id in orders:
+            if level is None or price != level.price:
+                level = price_map.get(price)
+                if level is None:
+                    level = self.create_price(price)
+            order = order_map[order_id] = Order(order_id, size, price, level)
+            level.append(order)
+        self.top_changed()
+
+    def bulk_load(self, orders):
+        price_map = self.price_map
+        order_map = self.order_map
+        levels = []
+        level = None
+        for price, size, order_id in orders:
+            if level is None or price != level.price:
+                level = price_map.get(price)
+                if level is None:
+                    level = price_map[price] = PriceLevel(price)
+                    levels.append(level)
+            order = order_map[order_id] = Order(order_id, size, price, level)
+            level.append(order)
+        if self.is_bid:
+            levels.reverse()
+        if any(levels[index].price > levels[index + 1].price for index in range(len(levels) - 1)):
+            levels.sort(key=lambda level: level.price)
+        self.price_tree = build_price_tree(levels)
+        ordered = levels[::-1] if self.is_bid else levels
+        for better, worse in zip(ordered, ordered[1:]):
+            better.worse = worse
+            worse.better = better
+        self.reset_best()
 
     def match(self, maker_order_id, match_size):
         order = self.order_map[maker_order_id]
-        original_size = order['size']
-        new_size = original_size - match_size
-        order['size'] = new_size
+        order.size -= match_size
+        level = order.level
+        level.size -= match_size
+        if level is self.best_level:
+            self.top_changed()
 
     def change(self, order_id, new_size):
         order = self.order_map[order_id]
-        order['size'] = new_size
+        level = order.level
+        level.size += new_size - order.size
+        order.size = new_size
+        if level is self.best_level:
+            self.top_changed()
 
     def remove_order(self, order_id):
-        if order_id in self.order_map:
-            order = self.order_map[order_id]
-            self.price_map[order['price']] = [o for o in self.price_map[order['price']] if o['order_id'] != order_id]
-            if not self.price_map[order['price']]:
-                self.remove_price(order['price'])
-            del self.order_map[order_id]
+        order = self.order_map.pop(order_id, None)
+        if order is not None:
+            level = order.level
+            level.remove(order)
+            if not level.count:
+                self.remove_price(order.price)
+            elif level is self.best_level:
+                self.top_changed()
         else:
-            del self.received_orders[order_id]
\ No newline at end of file
+            del self.received_orders[order_id]
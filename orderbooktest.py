@@ -1,10 +1,44 @@
+import asyncio
+import logging
+from logging.handlers import RotatingFileHandler
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
 import time
+import tracemalloc
+from decimal import Decimal
+from itertools import zip_longest
 try:
     import ujson as json
 except ImportError:
     import json
 
+from aiohttp import web
+from dateutil.parser import parse
+import numpy
+import requests
+import websockets
+
+from instrumentation.probes import LatencyProbes
+from instrumentation.queuelog import BatchingQueueHandler
+from orderbook.analytics import BookAnalytics
 from orderbook.book import Book
+from orderbook.capture import CaptureWriter, read_capture
+from orderbook.fixedpoint import price_parser, price_to_ticks, size_to_units, ticks_to_price, units_to_size
+from orderbook.depth import DepthPublisher, DepthReader
+from orderbook.manager import BookManager
+from orderbook.pipeline import DecodePipeline, normalize
+from orderbook.replay import Replay, compare_to_snapshot
+from orderbook.resync import BookSynchronizer
+from orderbook.synthetic import SyntheticFeed
+from orderbook.tape import MINUTE, SECOND, TradeTape, read_spill
+from orderbook.stats import RollingStats
+from orderbook.timestamps import datetime_from_ns, parse_time, parse_time_ns
+from orderbook.tree import Tree
 
 
 def dict_compare(variable_order_book, control_order_book, price_map=False, order_map=False):
@@ -23,46 +57,946 @@ def dict_compare(variable_order_book, control_order_book, price_map=False, order
             assert len(variable_order_book[key]) == len(control_order_book[key])
             zipped = zip(variable_order_book[key], control_order_book[key])
             for order in zipped:
-                assert order[0]['order_id'] == order[1]['order_id']
-                assert order[0]['price'] == order[1]['price']
-                assert order[0]['size'] == order[1]['size']
+                assert order[0].order_id == order[1].order_id
+                assert order[0].price == order[1].price
+                assert order[0].size == order[1].size
+            assert variable_order_book[key].size == control_order_book[key].size
         if order_map:
-            assert variable_order_book[key]['order_id'] == control_order_book[key]['order_id']
-            assert variable_order_book[key]['price'] == control_order_book[key]['price']
-            assert variable_order_book[key]['size'] == control_order_book[key]['size']
+            assert variable_order_book[key].order_id == control_order_book[key].order_id
+            assert variable_order_book[key].price == control_order_book[key].price
+            assert variable_order_book[key].size == control_order_book[key].size
 
 
-def test_orderbook():
-    variable_order_book = Book()
-    control_order_book = Book()
+def memory_report(level3, fixed_point=False):
+    tracemalloc.start()
+    order_book = Book(fixed_point=fixed_point)
+    before = tracemalloc.get_traced_memory()[0]
+    order_book.get_level3(level3)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    orders = len(order_book.bids.order_map) + len(order_book.asks.order_map)
+    print('fixed point: {0}, orders: {1}, bytes per order: {2:.0f}, max RSS: {3:.1f} MB'.format(
+        fixed_point, orders, (after - before) / max(orders, 1), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark_time_parsing(messages):
+    times = [message['time'] for message in messages]
+    for value in times[:1000]:
+        assert parse_time(value) == parse(value)
+        assert parse_time_ns(value) // 1000 == int(parse(value).timestamp() * 1e6 + 0.5)
+
+    for name, parser in (('dateutil', parse), ('parse_time', parse_time), ('parse_time_ns', parse_time_ns)):
+        start = time.time()
+        [parser(value) for value in times]
+        end = time.time()
+        print('{0} timestamps per sec: {1}'.format(name, int(len(times) / (end - start))))
+
+
+def replay(messages, beginning_level_3, ending_level_3, fixed_point=False):
+    variable_order_book = Book(fixed_point=fixed_point)
+    control_order_book = Book(fixed_point=fixed_point)
+
+    variable_order_book.get_level3(beginning_level_3)
+
+    start = time.time()
+    [variable_order_book.process_message(message) for message in messages]
+    end = time.time()
+    rate = len(messages) / (end - start)
+    print('fixed point: {0}, messages per sec: {1}'.format(fixed_point, int(rate)))
+
+    control_order_book.get_level3(ending_level_3)
+
+    dict_compare(variable_order_book.asks.price_map, control_order_book.asks.price_map, price_map=True)
+    dict_compare(variable_order_book.asks.order_map, control_order_book.asks.order_map, order_map=True)
+    dict_compare(variable_order_book.bids.price_map, control_order_book.bids.price_map, price_map=True)
+    dict_compare(variable_order_book.bids.order_map, control_order_book.bids.order_map, order_map=True)
 
-    with open('testdata/messages.json') as messages_json_file:
-        messages = json.load(messages_json_file)
+    assert variable_order_book.best_bid == control_order_book.best_bid
+    assert variable_order_book.best_ask == control_order_book.best_ask
+    assert variable_order_book.best_bid_size == control_order_book.best_bid_size
+    assert variable_order_book.best_ask_size == control_order_book.best_ask_size
+    return rate
 
+
+def load_messages(first_sequence, last_sequence):
+    """Feed messages with first_sequence < sequence <= last_sequence, in sequence order.
+
+    Prefers a binary capture from testdata/collectdata.py, which records the whole session around the
+    two snapshots, and falls back to the older, already trimmed messages.json.
+    """
+    for path in ('testdata/messages.cap', 'testdata/messages.cap.gz'):
+        if os.path.exists(path):
+            messages = [json.loads(frame) for receive_time, frame in read_capture(path) if b'"sequence"' in frame]
+            break
+    else:
+        with open('testdata/messages.json') as messages_json_file:
+            messages = json.load(messages_json_file)
+    messages = [message for message in messages if first_sequence < message['sequence'] <= last_sequence]
+    return sorted(messages, key=lambda message: message['sequence'])
+
+
+def test_orderbook():
     with open('testdata/beginning_level_3.json') as begin_json_file:
         beginning_level_3 = json.load(begin_json_file)
 
     with open('testdata/ending_level_3.json') as end_json_file:
         ending_level_3 = json.load(end_json_file)
 
+    messages = load_messages(beginning_level_3['sequence'], ending_level_3['sequence'])
+
     try:
         assert beginning_level_3['sequence'] + 1 == messages[0]['sequence']
         assert ending_level_3['sequence'] == messages[-1]['sequence']
     except AssertionError:
         print("Problem with sample data sequences")
 
-    variable_order_book.get_level3(beginning_level_3)
+    benchmark_time_parsing(messages)
 
-    start = time.time()
-    [variable_order_book.process_message(message) for message in messages]
-    end = time.time()
-    print('messages per sec: {0}'.format(int(len(messages)/(end-start))))
+    memory_report(beginning_level_3)
+    memory_report(beginning_level_3, fixed_point=True)
 
-    control_order_book.get_level3(ending_level_3)
+    decimal_rate = replay(messages, beginning_level_3, ending_level_3)
+    fixed_point_rate = replay(messages, beginning_level_3, ending_level_3, fixed_point=True)
+    print('fixed point throughput gain: {0:.2f}x'.format(fixed_point_rate / decimal_rate))
 
-    dict_compare(variable_order_book.asks.price_map, control_order_book.asks.price_map, price_map=True)
-    dict_compare(variable_order_book.asks.order_map, control_order_book.asks.order_map, order_map=True)
 
+def test_level_fifo():
+    tree = Tree(is_bid=True)
+    for order_id in ('o1', 'o2', 'o3'):
+        tree.receive(order_id, Decimal('1.0'))
+        tree.insert_order(order_id, Decimal('1.0'), Decimal('100.00'))
+    tree.remove_order('o2')
+    tree.receive('o4', Decimal('1.0'))
+    tree.insert_order('o4', Decimal('1.0'), Decimal('100.00'))
+    level = tree.price_map[Decimal('100.00')]
+    # the middle order leaves without disturbing queue priority, and newcomers join the back
+    assert [order.order_id for order in level] == ['o1', 'o3', 'o4']
+    assert len(level) == 3
+    tree.remove_order('o1')
+    tree.remove_order('o4')
+    assert [order.order_id for order in level] == ['o3']
+    assert level.head is level.tail
+
+
+def test_level_aggregates():
+    tree = Tree()
+    tree.load_orders([(Decimal('101.00'), Decimal('1.0'), 'a1'), (Decimal('101.00'), Decimal('2.5'), 'a2')])
+    level = tree.price_map[Decimal('101.00')]
+    assert (level.size, level.count) == (Decimal('3.5'), 2)
+    tree.match('a1', Decimal('0.25'))
+    tree.change('a2', Decimal('2.0'))
+    assert tree.order_map['a1'].size == Decimal('0.75')
+    assert (level.size, level.count) == (Decimal('2.75'), 2)
+    tree.remove_order('a1')
+    assert (level.size, level.count) == (Decimal('2.0'), 1)
+    assert not hasattr(tree.order_map['a2'], '__dict__') and not hasattr(level, '__dict__')
+
+
+def test_fixed_point_parsing():
+    assert price_to_ticks('3519.27') == 351927
+    assert price_to_ticks('3519') == 351900
+    assert price_to_ticks('3519.5') == 351950
+    assert price_to_ticks('3519.27000000') == 351927
+    assert size_to_units('0.5') == 50000000
+    assert size_to_units('12.00000001') == 1200000001
+    assert size_to_units('1.000000010') == 100000001
+    for parse, value in ((price_to_ticks, '0.03519'), (price_to_ticks, '3519.275'), (size_to_units, '0.000000001')):
+        try:
+            parse(value)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('{0} parsed {1} without its last digits'.format(parse.__name__, value))
+    assert ticks_to_price(351927) == Decimal('3519.27')
+    assert units_to_size(50000000) == Decimal('0.5')
+
+
+def test_parse_time():
+    for value in ('2015-01-07T23:47:45.708531Z', '2015-01-07T23:47:45Z', '2015-01-07T23:47:45.7Z',
+                  '2015-01-07T23:47:45.0708Z', '2024-02-29T00:00:00.000001Z', '1970-01-01T00:00:00.5Z'):
+        assert parse_time(value) == parse(value)
+        assert parse_time_ns(value) == round(parse(value).timestamp() * 1e6) * 1000
+        assert datetime_from_ns(parse_time_ns(value)) == parse_time(value)
+    assert parse_time_ns('2015-01-07T23:47:45.123456789Z') % 1000000000 == 123456789
+
+
+def test_unsequenced_messages():
+    order_book = Book()
+    order_book.get_level3({'sequence': 1, 'bids': [['100.00', '1.0', 'b1']], 'asks': []})
+    assert order_book.process_message({'type': 'activate', 'side': 'buy', 'product_id': 'BTC-USD',
+                                       'timestamp': '1483736448.299000', 'order_id': 's1', 'stop_type': 'entry',
+                                       'size': '1.0', 'funds': '10.00', 'taker_fee_rate': '0.0025',
+                                       'private': True})
+    assert order_book.process_message({'type': 'subscriptions', 'channels': []})
+    assert not order_book.process_message({'type': 'unknown'})
+    assert order_book.last_sequence == 0 and not order_book.gap_count
+    # an unknown type on the sequenced feed is unhandled but still takes its sequence number
+    assert not order_book.process_message({'type': 'unknown', 'sequence': 2, 'time': '2017-01-06T21:00:48.299Z'})
+    assert order_book.last_sequence == 2
+    assert order_book.process_message({'type': 'done', 'side': 'buy', 'sequence': 3, 'order_id': 'b1',
+                                       'reason': 'canceled', 'time': '2017-01-06T21:00:49.299Z'})
+    assert order_book.last_sequence == 3 and not order_book.gap_count and order_book.best_bid is None
+
+
+def test_best_price_cache():
+    for fixed_point in (False, True):
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3({'sequence': 1,
+                               'bids': [['100.00', '1.0', 'b1'], ['100.00', '2.0', 'b2'], ['99.00', '3.0', 'b3']],
+                               'asks': [['101.00', '1.5', 'a1'], ['102.00', '2.5', 'a2']]})
+        assert (order_book.best_bid, order_book.best_bid_size) == (Decimal('100.00'), Decimal('3.0'))
+        assert order_book.spread == Decimal('1.00')
+        sequence = 1
+        for side, order_id in (('buy', 'b1'), ('buy', 'b2'), ('sell', 'a1')):
+            sequence += 1
+            assert order_book.process_message({'type': 'done', 'side': side, 'sequence': sequence,
+                                               'order_id': order_id, 'time': '2015-01-01T00:00:00.000000Z'})
+        # both best levels emptied, so the next level in is the new top of book
+        assert (order_book.best_bid, order_book.best_bid_size) == (Decimal('99.00'), Decimal('3.0'))
+        assert (order_book.best_ask, order_book.best_ask_size) == (Decimal('102.00'), Decimal('2.5'))
+        assert order_book.process_message({'type': 'done', 'side': 'buy', 'sequence': sequence + 1,
+                                           'order_id': 'b3', 'time': '2015-01-01T00:00:00.000000Z'})
+        assert order_book.best_bid is None and order_book.best_bid_size is None
+        assert order_book.bids.best_level is None
+
+
+def test_top_of_book_events():
+    order_book = Book()
+    order_book.get_level3({'sequence': 1,
+                           'bids': [['100.00', '1.0', 'b1'], ['99.00', '2.0', 'b2']],
+                           'asks': [['101.00', '1.5', 'a1']]})
+    versions = []
+    order_book.updates.subscribe(versions.append)
+
+    async def wait_for_change():
+        version = order_book.updates.version
+        return await order_book.updates.wait(version)
+
+    loop = asyncio.new_event_loop()
+    waiter = loop.create_task(wait_for_change())
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not waiter.done()
+
+    # a change below the top of book does not wake anybody
+    assert order_book.process_message({'type': 'change', 'side': 'buy', 'sequence': 2, 'order_id': 'b2',
+                                       'new_size': '1.0', 'time': '2015-01-01T00:00:00.000000Z'})
+    assert not versions
+    assert order_book.process_message({'type': 'done', 'side': 'buy', 'sequence': 3, 'order_id': 'b1',
+                                       'time': '2015-01-01T00:00:01.000000Z'})
+    assert loop.run_until_complete(waiter) == versions[-1]
+    loop.close()
+    assert order_book.best_bid == Decimal('99.00')
+    assert order_book.best_bid_size == Decimal('1.0')
+    assert order_book.spread == Decimal('2.00')
+
+
+def test_rolling_stats():
+    stats = RollingStats(window=100000, unit=1)
+    times = []
+    timestamp = 0
+    for _ in range(5000):
+        timestamp += random.randint(0, 4000)
+        stats.add(timestamp)
+        times.append(timestamp)
+        window = [t for t in times if t >= timestamp - 100000]
+        gaps = [b - a for a, b in zip(window, window[1:])]
+        assert len(stats) == len(gaps)
+        if gaps:
+            assert stats.minimum == min(gaps)
+            assert stats.maximum == max(gaps)
+            assert abs(stats.mean - sum(gaps) / len(gaps)) < 1e-9
+            median = sorted(gaps)[(len(gaps) - 1) // 2]
+            assert median <= stats.percentile(50) <= median * 1.125
+
+
+def test_latency_probes():
+    latency_probes = LatencyProbes()
+    values = [random.randint(0, 10 ** 7) for _ in range(10000)]
+    for value in values:
+        latency_probes.record('stage', value)
+    latency_probes.record('skew', -5)
+    summary = latency_probes.summary()
+    assert summary['skew']['max'] == 0
+    values.sort()
+    assert summary['stage']['count'] == len(values)
+    assert summary['stage']['max'] == values[-1]
+    for percent in (50, 99):
+        exact = values[int(len(values) * percent / 100.0) - 1]
+        assert exact <= summary['stage']['p{0}'.format(percent)] <= exact * 1.125 + 1
+
+
+def test_batching_queue_handler():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'log.csv')
+        file_handler = RotatingFileHandler(path, 'a', 4096, 3)
+        file_handler.setFormatter(logging.Formatter('%(levelname)s, %(message)s'))
+        handler = BatchingQueueHandler(file_handler, capacity=50)
+        logger = logging.getLogger('batching_queue_handler_test')
+        logger.propagate = False
+        logger.addHandler(handler)
+
+        # while the writer is stuck behind the file lock the queue fills up and further records are dropped
+        file_handler.acquire()
+        for number in range(200):
+            logger.error('record %s', number)
+        file_handler.release()
+        handler.close()
+        logger.removeHandler(handler)
+
+        assert handler.dropped > 0
+        assert handler.written + handler.dropped == 200
+        assert handler.depth == 0
+        lines = []
+        for name in sorted(os.listdir(directory), reverse=True):
+            with open(os.path.join(directory, name)) as log_file:
+                lines.extend(log_file.read().splitlines())
+        assert len(lines) == handler.written
+        assert lines[0] == 'ERROR, record 0'
+
+
+
+def test_package_imports():
+    # neither package may load the other, or the pair only imports in one order
+    for module, other in (('orderbook.book', 'trading'), ('orderbook.resync', 'trading'), ('trading', 'orderbook'),
+                          ('instrumentation.probes', 'orderbook'), ('instrumentation.probes', 'trading')):
+        code = 'import sys, {0}; sys.exit({1!r} in sys.modules)'.format(module, other)
+        assert subprocess.call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))) == 0
+
+def test_capture_round_trip():
+    frames = [json.dumps({'type': 'heartbeat', 'sequence': sequence}) for sequence in range(1000)]
+    with tempfile.TemporaryDirectory() as directory:
+        for compress in (False, True):
+            path = os.path.join(directory, 'messages.cap')
+            with CaptureWriter(path, compress=compress) as capture:
+                for receive_time, frame in enumerate(frames):
+                    capture.write(frame, receive_time)
+            records = list(read_capture(path))
+            assert [receive_time for receive_time, frame in records] == list(range(1000))
+            assert [frame.decode('utf-8') for receive_time, frame in records] == frames
+
+
+def test_replay_checkpoints():
+    beginning_level_3 = {'sequence': 10,
+                         'bids': [['100.00', '1.0', 'b1']],
+                         'asks': [['101.00', '1.5', 'a1'], ['101.00', '0.5', 'a2']]}
+    messages = [
+        {'type': 'received', 'side': 'sell', 'sequence': 11, 'order_id': 'a3', 'size': '2.0',
+         'order_type': 'limit', 'time': '2015-01-01T00:00:00.000000Z'},
+        {'type': 'open', 'side': 'sell', 'sequence': 12, 'order_id': 'a3', 'remaining_size': '2.0',
+         'price': '102.00', 'time': '2015-01-01T00:00:00.010000Z'},
+        {'type': 'match', 'side': 'sell', 'sequence': 13, 'maker_order_id': 'a1', 'size': '0.5',
+         'price': '101.00', 'time': '2015-01-01T00:00:00.020000Z'},
+        {'type': 'done', 'side': 'sell', 'sequence': 14, 'order_id': 'a2', 'time': '2015-01-01T00:00:00.030000Z'},
+    ]
+    ending_level_3 = {'sequence': 14,
+                      'bids': [['100.00', '1.0', 'b1']],
+                      'asks': [['101.00', '1.0', 'a1'], ['102.00', '2.0', 'a3']]}
+    stale_level_3 = {'sequence': 13, 'bids': ending_level_3['bids'], 'asks': ending_level_3['asks']}
+
+    for speed in (None, 100.0):
+        order_book = Book()
+        order_book.get_level3(beginning_level_3)
+        records = [(parse_time_ns(message['time']), message) for message in messages]
+        replay = Replay(order_book, records, speed=speed, checkpoints={13: stale_level_3, 14: ending_level_3})
+        report = replay.run()
+        assert report['messages'] == 4
+        assert report['latency_ns']['count'] == 4
+        assert report['checkpoints'][0]['differences']
+        assert not report['checkpoints'][1]['differences']
+        assert not replay.consistent
+
+    order_book = Book()
+    order_book.get_level3(beginning_level_3)
+    replay = Replay(order_book, [(0, message) for message in messages], checkpoints={14: ending_level_3,
+                                                                                     20: ending_level_3})
+    report = replay.run()
+    assert not report['checkpoints'][0]['differences']
+    assert report['checkpoints'][1]['sequence'] == 20 and report['checkpoints'][1]['differences']
+    assert not replay.consistent
+
+    # the incrementally kept level aggregates and ladder links are checked too, not only the orders
+    level = order_book.asks.level(Decimal('101.00'))
+    level.size += 1
+    assert compare_to_snapshot(order_book, ending_level_3) == \
+        ['asks: level 101.00 holds 1 orders of 2.0 but its orders sum to 1 of 1.0']
+    level.size -= 1
+    level.count += 1
+    assert len(compare_to_snapshot(order_book, ending_level_3)) == 1
+    level.count -= 1
+    assert not compare_to_snapshot(order_book, ending_level_3)
+    top, next_level = order_book.asks.top_levels(2)
+    top.worse, next_level.better = None, None
+    assert compare_to_snapshot(order_book, ending_level_3) == \
+        ['asks: price ladder is not in the snapshot\'s price order']
+    top.worse, next_level.better = next_level, next_level
+    assert compare_to_snapshot(order_book, ending_level_3) == ['asks: better links do not mirror the worse links']
+
+
+def test_synthetic_replay():
+    for fixed_point in (False, True):
+        feed = SyntheticFeed(orders=500, levels=50, seed=7)
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3(feed.snapshot())
+        messages = list(feed.messages(20000))
+        ending_level_3 = feed.snapshot()
+        replay = Replay(order_book, ((0, message) for message in messages),
+                        checkpoints={ending_level_3['sequence']: ending_level_3})
+        report = replay.run()
+        assert report['messages'] == len(messages)
+        assert replay.consistent
+
+
+class FakeFeed(object):
+    """Local websocket feed and level 3 endpoint over a SyntheticFeed, dropping the messages in gaps."""
+
+    def __init__(self, feed, count, gaps=(), snapshot_delay=0.05):
+        self.feed = feed
+        self.count = count
+        self.gaps = set(gaps)
+        self.snapshot_delay = snapshot_delay
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/feed', self.stream)
+        app.router.add_get('/book', self.book)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def stream(self, request):
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        # like the real feed, the first messages arrive before the client has its first snapshot
+        await asyncio.sleep(0.01)
+        for index, message in enumerate(self.feed.messages(self.count)):
+            if index in self.gaps:
+                # let the previous snapshot load first, so each gap is recovered on its own
+                await asyncio.sleep(0.2)
+                continue
+            await websocket.send_str(json.dumps(message))
+            await asyncio.sleep(0)
+        await websocket.close()
+        return websocket
+
+    async def book(self, request):
+        level3 = self.feed.snapshot()
+        await asyncio.sleep(self.snapshot_delay)
+        return web.json_response(level3)
+
+
+def test_stream_level3():
+    feed = SyntheticFeed(orders=2000, levels=100, seed=5)
+    for message in feed.messages(1000):
+        pass
+    level3 = feed.snapshot()
+    document = json.dumps(level3).encode('utf-8')
+    for fixed_point in (False, True):
+        # every chunk size splits tokens at different places
+        for chunk_size in (1, 7, 64, 4096):
+            order_book = Book(fixed_point=fixed_point)
+            order_book.stream_level3(document[start:start + chunk_size]
+                                     for start in range(0, len(document), chunk_size))
+            assert order_book.level3_sequence == level3['sequence']
+            assert len(order_book.bids.order_map) == len(level3['bids'])
+            assert len(order_book.asks.order_map) == len(level3['asks'])
+            assert not compare_to_snapshot(order_book, level3)
+            assert order_book.best_bid == order_book.decimal_price(order_book.parse_price(level3['bids'][0][0]))
+            assert order_book.best_ask == order_book.decimal_price(order_book.parse_price(level3['asks'][0][0]))
+
+
+def black_height(node):
+    if node is None:
+        return 1
+    if node.red:
+        assert not (node.left is not None and node.left.red) and not (node.right is not None and node.right.red)
+    height = black_height(node.left)
+    assert height == black_height(node.right)
+    return height + (0 if node.red else 1)
+
+
+def test_tree_from_snapshot():
+    level3 = SyntheticFeed(orders=3000, levels=400, seed=3).snapshot()
+    for side, is_bid in (('bids', True), ('asks', False)):
+        orders = [(price_to_ticks(price), size_to_units(size), order_id) for price, size, order_id in level3[side]]
+        control = Tree(is_bid=is_bid)
+        for price, size, order_id in orders:
+            control.insert_order(order_id, size, price, initial=True)
+        # out of order levels are sorted rather than trusted
+        for snapshot_orders in (orders, orders[::-1]):
+            tree = Tree.from_snapshot(snapshot_orders, is_bid=is_bid)
+            assert list(tree.price_tree.keys()) == list(control.price_tree.keys())
+            assert tree.best_price == control.best_price
+            assert len(tree.order_map) == len(control.order_map)
+            if tree.price_tree.__class__.__name__ == 'RBTree':
+                assert not tree.price_tree._root.red
+                black_height(tree.price_tree._root)
+        tree = Tree.from_snapshot(orders, is_bid=is_bid)
+        for price in tree.price_map:
+            assert [(order.order_id, order.size) for order in tree.price_map[price]] == \
+                   [(order.order_id, order.size) for order in control.price_map[price]]
+        # the built index keeps working under ordinary inserts and removes
+        for price, size, order_id in orders[::2]:
+            tree.remove_order(order_id)
+        tree.insert_order('new', 100000000, orders[0][0] + (1 if is_bid else -1), initial=True)
+        assert tree.best_price == orders[0][0] + (1 if is_bid else -1)
+        assert list(tree.price_tree.keys()) == sorted(tree.price_map)
+
+
+def check_level_links(tree):
+    levels = list(tree.iter_levels())
+    assert [level.price for level in levels] == list(tree.price_tree.keys(reverse=tree.is_bid))
+    assert all(worse.better is better for better, worse in zip(levels, levels[1:]))
+    assert not levels or (levels[0] is tree.best_level and levels[0].better is None and levels[-1].worse is None)
+    for level in levels:
+        assert tree.level(level.price) is level
+        assert level.size == sum(order.size for order in level)
+        assert level.count == len(list(level))
+
+
+def test_level2_view():
+    feed = SyntheticFeed(orders=400, levels=40, seed=23)
+    order_book = Book(fixed_point=True)
+    order_book.get_level3(feed.snapshot())
+    # a second snapshot on top goes through the incremental, not the bulk, load
+    order_book.bids.load_orders([(600000, 100000000, 'deep bid'), (650001, 100000000, 'top bid')])
+    check_level_links(order_book.bids)
+    order_book.bids.remove_order('top bid')
+    order_book.bids.remove_order('deep bid')
+    for index, message in enumerate(feed.messages(5000)):
+        assert order_book.process_message(message)
+        if index % 250 == 0:
+            check_level_links(order_book.bids)
+            check_level_links(order_book.asks)
+    depth = order_book.depth(3)
+    assert len(depth['bids']) == 3
+    assert depth['bids'][0] == (order_book.best_bid, order_book.best_bid_size, order_book.bids.best_level.count)
+    assert depth['asks'][0][0] == order_book.best_ask
+    assert depth['bids'][0][0] > depth['bids'][1][0] > depth['bids'][2][0]
+    assert depth['asks'][0][0] < depth['asks'][1][0] < depth['asks'][2][0]
+
+
+def test_book_analytics():
+    for fixed_point in (False, True):
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3({'sequence': 1,
+                               'bids': [['100.00', '1.0', 'b1'], ['100.00', '1.0', 'b2'], ['99.50', '3.0', 'b3'],
+                                        ['98.00', '5.0', 'b4']],
+                               'asks': [['101.00', '1.0', 'a1'], ['101.25', '2.0', 'a2'], ['103.00', '4.0', 'a3']]})
+        analytics = BookAnalytics(order_book)
+
+        cost, average, worst = analytics.sweep_cost([0.5, 2.0, 7.0, 8.0])
+        assert numpy.allclose(cost[:3], [50.5, 101.0 + 101.25, 101.0 + 202.5 + 412.0])
+        assert numpy.allclose(average[1], (101.0 + 101.25) / 2)
+        assert numpy.allclose(worst[:3], [101.0, 101.25, 103.0])
+        assert numpy.isnan(cost[3])
+        cost, average, worst = analytics.sweep_cost(2.5, side='bids')
+        assert numpy.isclose(cost, 200.0 + 0.5 * 99.5)
+
+        assert numpy.isclose(analytics.microprice(), (100.0 * 1.0 + 101.0 * 2.0) / 3.0)
+        assert numpy.isclose(analytics.imbalance(), (2.0 - 1.0) / 3.0)
+        assert numpy.isclose(analytics.imbalance(levels=2), (5.0 - 3.0) / 8.0)
+        bid_depth, ask_depth = analytics.depth_at([0, 50, 200])
+        assert numpy.allclose(bid_depth, [2.0, 5.0, 10.0])
+        assert numpy.allclose(ask_depth, [1.0, 3.0, 7.0])
+        # everything above came from one export per side
+        assert analytics.exports == 2
+
+        assert order_book.process_message({'type': 'done', 'side': 'sell', 'sequence': 2, 'order_id': 'a1',
+                                           'time': '2015-01-01T00:00:00.000000Z'})
+        assert numpy.isclose(analytics.sweep_cost(1.0)[0], 101.25)
+        assert analytics.exports == 3
+
+
+def test_gap_resync():
+    feed = SyntheticFeed(orders=500, levels=50, seed=11)
+    server = FakeFeed(feed, 3000, gaps=(1000, 2000))
+    order_book = Book(fixed_point=True)
+
+    async def run():
+        await server.start()
+        url = 'http://127.0.0.1:{0}/book'.format(server.port)
+        synchronizer = BookSynchronizer(order_book, fetch=lambda: requests.get(url).json())
+        async with websockets.connect('ws://127.0.0.1:{0}/feed'.format(server.port)) as websocket:
+            synchronizer.start()
+            async for message in websocket:
+                assert synchronizer.process_message(json.loads(message))
+        while synchronizer.resyncing:
+            await asyncio.sleep(0.01)
+        await server.stop()
+        return synchronizer
+
+    synchronizer = asyncio.new_event_loop().run_until_complete(run())
+    # the initial load plus one resync per gap, all over the same connection
+    assert synchronizer.resyncs == 3
+    assert order_book.gap_count == 2
+    assert order_book.last_sequence == feed.sequence
+    assert not compare_to_snapshot(order_book, feed.snapshot())
+
+
+def test_stale_snapshot_retry():
+    feed = SyntheticFeed(orders=300, levels=30, seed=13)
+    stale_level_3 = feed.snapshot()
+    first = list(feed.messages(10))
+    fresh_level_3 = feed.snapshot()
+    rest = list(feed.messages(10))
+    fetched = []
+
+    def fetch():
+        fetched.append(time.perf_counter())
+        return (stale_level_3, fresh_level_3)[len(fetched) - 1]
+
+    order_book = Book()
+
+    async def run():
+        synchronizer = BookSynchronizer(order_book, fetch=fetch, retry_delay=0.2)
+        synchronizer.start()
+        # the buffer starts after the stale snapshot, so the first load finds a gap
+        for message in first[5:] + rest:
+            assert synchronizer.process_message(message)
+        while synchronizer.resyncing:
+            await asyncio.sleep(0.01)
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert len(fetched) == 2
+    assert fetched[1] - fetched[0] >= 0.2
+    assert order_book.last_sequence == feed.sequence
+    assert not compare_to_snapshot(order_book, feed.snapshot())
+    # the buffered match the fresh snapshot already covers still reaches the tape, before the applied one
+    matches = [message for message in first[5:] + rest if message['type'] == 'match']
+    assert len(matches) == 2
+    assert list(order_book.trades.times) == [parse_time_ns(message['time']) for message in matches]
+
+
+def test_book_manager():
+    feeds = {product_id: SyntheticFeed(orders=300, levels=40, seed=seed, product_id=product_id)
+             for seed, product_id in enumerate(('BTC-USD', 'ETH-USD', 'LTC-USD'))}
+    snapshots = {product_id: feed.snapshot() for product_id, feed in feeds.items()}
+    manager = BookManager(sorted(feeds), fixed_point=True, fetch=snapshots.get)
+    assert json.loads(manager.subscribe_message())['product_ids'] == ['BTC-USD', 'ETH-USD', 'LTC-USD']
+
+    streams = {product_id: list(feed.messages(2000)) for product_id, feed in feeds.items()}
+    interleaved = [message for messages in zip_longest(*streams.values()) for message in messages if message]
+
+    async def run():
+        manager.start()
+        assert manager.process_message({'type': 'subscriptions', 'channels': []})
+        # the first messages of each product are buffered until its snapshot has loaded
+        for message in interleaved[:30]:
+            assert manager.process_message(message)
+        while manager.resyncing:
+            await asyncio.sleep(0.01)
+        for message in interleaved[30:]:
+            assert manager.process_message(message)
+
+    asyncio.new_event_loop().run_until_complete(run())
+    for product_id, feed in feeds.items():
+        order_book = manager[product_id]
+        assert order_book.product_id == product_id
+        assert order_book.last_sequence == streams[product_id][-1]['sequence']
+        assert manager.stats()[product_id]['resyncs'] == 1
+        assert not compare_to_snapshot(order_book, feed.snapshot())
+
+
+def test_decode_pipeline():
+    feed = SyntheticFeed(orders=500, levels=50, seed=13)
+    level3 = feed.snapshot()
+    messages = list(feed.messages(5000))
+    order_book = Book(fixed_point=True, normalized=True)
+    order_book.get_level3(level3)
+    pipeline = DecodePipeline(workers=3, capacity=1 << 16)
+    try:
+        decoded = []
+        for message in messages:
+            pipeline.submit(json.dumps(message))
+            decoded.extend(pipeline.ready())
+        decoded.extend(pipeline.drain())
+    finally:
+        pipeline.close()
+    assert [message['sequence'] for message in decoded] == [message['sequence'] for message in messages]
+    assert all(isinstance(message['price'], int) for message in decoded)
+    assert decoded[0]['time_ns'] == parse_time_ns(messages[0]['time'])
+    for message in decoded:
+        assert order_book.process_message(message)
+    assert not compare_to_snapshot(order_book, feed.snapshot())
+
+    more = list(feed.messages(2000))
+    pipeline = DecodePipeline(workers=2, capacity=1 << 16)
+
+    async def run():
+        applied = []
+
+        async def apply():
+            async for message in pipeline.messages():
+                assert order_book.process_message(message)
+                applied.append(message)
+
+        applier = asyncio.ensure_future(apply())
+        for index, message in enumerate(more):
+            pipeline.submit(json.dumps(message))
+            if index % 100 == 0:
+                await asyncio.sleep(0.001)
+        while len(applied) < len(more):
+            await asyncio.sleep(0.01)
+        # with nothing in flight the applier sleeps on the wake pipe rather than polling
+        cpu = time.process_time()
+        await asyncio.sleep(0.3)
+        idle_cpu = time.process_time() - cpu
+        applier.cancel()
+        return idle_cpu
+
+    try:
+        idle_cpu = asyncio.new_event_loop().run_until_complete(run())
+    finally:
+        pipeline.close()
+    assert idle_cpu < 0.05
+    assert order_book.last_sequence == feed.sequence
+
+
+
+def test_decode_pipeline_failures():
+    frames = [json.dumps({'type': 'heartbeat', 'sequence': 1}), '{"type": "open", "sequence"',
+              json.dumps({'type': 'open', 'side': 'buy', 'sequence': 2, 'order_id': 'b1', 'price': '100.001',
+                          'remaining_size': '1.0', 'time': '2015-01-01T00:00:00.000000Z'}),
+              json.dumps({'type': 'heartbeat', 'sequence': 3})]
+    pipeline = DecodePipeline(workers=2, capacity=1 << 16)
+    try:
+        for frame in frames:
+            pipeline.submit(frame)
+        # bad frames raise in their place, and the workers carry on with the frames after them
+        results = []
+        while len(results) < len(frames):
+            try:
+                results.extend(message['sequence'] for message in pipeline.drain())
+            except ValueError as error:
+                results.append(str(error))
+    finally:
+        pipeline.close()
+    assert results[0] == 1 and results[3] == 3
+    assert 'JSONDecodeError' in results[1] or 'ValueError' in results[1]
+    assert 'more than 2 decimal places' in results[2]
+
+    # a dead worker makes submit raise once its ring fills, rather than spin forever
+    pipeline = DecodePipeline(workers=1, capacity=1 << 12)
+    pipeline.processes[0].kill()
+    pipeline.processes[0].join()
+    try:
+        for _ in range(1000):
+            pipeline.submit(frames[0])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('submit kept waiting on a dead worker')
+    try:
+        pipeline.close()
+    except RuntimeError:
+        pass
+
+    # and wakes messages() up to raise, rather than leave it waiting for a result that never comes
+    pipeline = DecodePipeline(workers=2, capacity=1 << 16)
+
+    async def run():
+        async def apply():
+            async for _ in pipeline.messages():
+                pass
+        applier = asyncio.ensure_future(apply())
+        await asyncio.sleep(0.1)
+        # nothing waits on the killed worker yet, only its exit can wake the applier
+        pipeline.processes[1].kill()
+        pipeline.submit(frames[0])
+        try:
+            await asyncio.wait_for(applier, 10)
+        except RuntimeError:
+            return True
+        return False
+
+    try:
+        assert asyncio.new_event_loop().run_until_complete(run())
+    finally:
+        try:
+            pipeline.close()
+        except RuntimeError:
+            pass
+
+def read_depth(path, results):
+    reader = DepthReader(path)
+    results.put(reader.read())
+    reader.close()
+
+
+def expected_depth(order_book, levels):
+    def side(tree):
+        return [(int(order_book.decimal_price(level.price).scaleb(2)),
+                 int(order_book.decimal_size(level.size).scaleb(8)), level.count)
+                for level in list(tree.price_tree.values(reverse=tree.is_bid))[:levels]]
+    return side(order_book.bids), side(order_book.asks)
+
+
+def test_depth_publisher():
+    for fixed_point in (False, True):
+        feed = SyntheticFeed(orders=300, levels=30, seed=17)
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3(feed.snapshot())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'depth')
+            publisher = DepthPublisher(order_book, path=path, levels=5)
+            reader = DepthReader(path)
+            published = 0
+            for message in feed.messages(3000):
+                assert order_book.process_message(message)
+                dirty = publisher.dirty or publisher.affects(message)
+                publisher.update(message)
+                published += dirty
+                depth = reader.read()
+                assert depth['sequence'] == message['sequence']
+                assert (depth['bids'], depth['asks']) == expected_depth(order_book, 5)
+            # most messages land deeper in the book than the published levels
+            assert published < 3000
+            # stop order activations have neither a time nor a sequence, and leave the depth as it was
+            activate = {'type': 'activate', 'side': 'buy', 'product_id': 'BTC-USD', 'timestamp': '1483736448.299000',
+                        'order_id': 's1', 'stop_type': 'entry', 'size': '1.0', 'funds': '10.00', 'private': True}
+            assert order_book.process_message(activate)
+            publisher.update(activate)
+            assert reader.read() == depth
+            assert reader.decimal_level(depth['bids'][0])[0] == order_book.best_bid
+
+            results = multiprocessing.get_context('spawn').Queue()
+            process = multiprocessing.get_context('spawn').Process(target=read_depth, args=(path, results))
+            process.start()
+            assert results.get(timeout=60) == depth
+            process.join()
+            reader.close()
+            publisher.close()
+
+
+def test_price_places():
+    level3 = {'sequence': 1, 'bids': [['0.03519', '2.5', 'b1'], ['0.03518', '1.0', 'b2']],
+              'asks': [['0.03521', '1.0', 'a1'], ['0.03524', '2.0', 'a2']]}
+    # cents would collapse every ETH-BTC level into one, so the default places refuse these prices
+    try:
+        Book(product_id='ETH-BTC', fixed_point=True).get_level3(level3)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('ETH-BTC prices loaded into cents')
+
+    manager = BookManager(['BTC-USD', 'ETH-BTC'], fixed_point=True, normalized=True, price_places={'ETH-BTC': 5})
+    assert manager['BTC-USD'].price_places == 2
+    order_book = manager['ETH-BTC']
+    order_book.get_level3(level3)
+    assert order_book.bids.best_price == 3519 and len(order_book.bids.price_map) == 2
+    message = normalize({'type': 'match', 'side': 'sell', 'sequence': 2, 'maker_order_id': 'a1', 'size': '0.5',
+                         'price': '0.03521', 'product_id': 'ETH-BTC', 'time': '2015-01-01T00:00:00.000000Z'},
+                        {'ETH-BTC': price_parser(5)})
+    assert message['price'] == 3521
+    assert order_book.process_message(message)
+    assert order_book.best_ask == Decimal('0.03521') and order_book.best_ask_size == Decimal('0.5')
+    assert order_book.depth(1)['bids'] == [(Decimal('0.03519'), Decimal('2.5'), 1)]
+
+    analytics = BookAnalytics(order_book)
+    assert numpy.isclose(analytics.sweep_cost(1.0)[0], 0.5 * 0.03521 + 0.5 * 0.03524)
+    bid_depth, ask_depth = analytics.depth_at([0, 1, 3])
+    assert numpy.allclose(bid_depth, [2.5, 3.5, 3.5])
+    assert numpy.allclose(ask_depth, [0.5, 0.5, 2.5])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'depth')
+        publisher = DepthPublisher(order_book, path=path, levels=2)
+        publisher.publish()
+        reader = DepthReader(path)
+        assert reader.decimal_level(reader.read()['bids'][1])[0] == Decimal('0.03518')
+        reader.close()
+        publisher.close()
+
+
+def test_trade_tape():
+    with tempfile.TemporaryDirectory() as directory:
+        spill_path = os.path.join(directory, 'trades')
+        tape = TradeTape(capacity=4, vwap_window=2 * SECOND, spill_path=spill_path)
+        # one trade every half second, priced 100 + n ticks and sized 1 + n units
+        for n in range(12):
+            tape.add(n * SECOND // 2, 1 if n % 2 else -1, 100 + n, 1 + n)
+        # the window holds the trades less than two seconds older than the last, n = 8 to 11
+        window = range(8, 12)
+        assert tape.window_trades == 4
+        assert abs(tape.vwap - sum((100 + n) * (1 + n) for n in window) / sum(1 + n for n in window)) < 1e-9
+        assert tape.last(2) == [(11 * SECOND // 2, 1, 111, 12), (5 * SECOND, -1, 110, 11)]
+
+        seconds = tape.ohlcv(SECOND)
+        assert [bar[0] for bar in seconds] == [n * SECOND for n in range(6)]
+        start, open_price, high, low, close, volume, vwap, count = seconds[1]
+        assert (open_price, high, low, close, volume, count) == (102, 103, 102, 103, 7, 2)
+        assert abs(vwap - (102 * 3 + 103 * 4) / 7.0) < 1e-9
+        assert tape.ohlcv(SECOND, 2)[-1][0] == 5 * SECOND
+        assert tape.ohlcv(MINUTE) == [(0, 100, 111, 100, 111, 78, sum((100 + n) * (1 + n) for n in range(12)) / 78.0,
+                                       12)]
+
+        # retention trims in blocks, spilling what it drops, and never drops a trade in the window
+        assert len(tape) < 8 and tape.total == 12
+        spilled = list(read_spill(spill_path))
+        assert len(spilled) == tape.spilled
+        assert spilled + list(zip(tape.times, tape.sides, tape.prices, tape.sizes)) == \
+            [(n * SECOND // 2, 1 if n % 2 else -1, 100 + n, 1 + n) for n in range(12)]
+
+    for fixed_point in (False, True):
+        order_book = Book(fixed_point=fixed_point)
+        order_book.get_level3({'sequence': 1, 'bids': [['100.00', '2.0', 'b1']], 'asks': [['101.00', '1.0', 'a1']]})
+        assert order_book.process_message({'type': 'match', 'side': 'buy', 'sequence': 2, 'maker_order_id': 'b1',
+                                           'taker_order_id': 't1', 'price': '100.00', 'size': '0.12345678',
+                                           'time': '2015-01-01T00:00:00.250000Z'})
+        time_ns = parse_time_ns('2015-01-01T00:00:00.250000Z')
+        # the tape holds the feed's values exactly as fixed point ints, whatever the book's mode
+        assert order_book.trades.last(1) == [(time_ns, 1, price_to_ticks('100.00'), size_to_units('0.12345678'))]
+        assert order_book.trades.ohlcv(SECOND) == [(time_ns - time_ns % SECOND, 10000, 10000, 10000, 10000,
+                                                    12345678, 10000.0, 1)]
+        # and matches keeps its old shape, with the feed's own digits
+        matches = order_book.matches
+        assert list(matches) == [(parse_time('2015-01-01T00:00:00.250000Z'), 'buy', Decimal('0.12345678'),
+                                  Decimal('100.00'))]
+        assert str(matches[0][2]) == '0.12345678' and str(matches[0][3]) == '100.00'
+        # the view is only extended by the trades added since it was last read
+        assert order_book.matches is matches
+        first = matches[0]
+        assert order_book.process_message({'type': 'match', 'side': 'sell', 'sequence': 3, 'maker_order_id': 'a1',
+                                           'taker_order_id': 't2', 'price': '101.00', 'size': '1.0',
+                                           'time': '2015-01-01T00:00:00.500000Z'})
+        assert [match[1] for match in order_book.matches] == ['sell', 'buy'] and order_book.matches[1] is first
+        for sequence in range(4, 204):
+            order_book.record_trade({'type': 'match', 'side': 'buy', 'sequence': sequence, 'price': '99.00',
+                                     'size': '0.1', 'time': '2015-01-01T00:00:01.000000Z'})
+        assert len(order_book.matches) == 100 and order_book.matches[-1][3] == Decimal('99.00')
 
 if __name__ == '__main__':
     test_orderbook()
+    test_level_fifo()
+    test_level_aggregates()
+    test_fixed_point_parsing()
+    test_parse_time()
+    test_unsequenced_messages()
+    test_best_price_cache()
+    test_top_of_book_events()
+    test_rolling_stats()
+    test_latency_probes()
+    test_batching_queue_handler()
+    test_package_imports()
+    test_capture_round_trip()
+    test_replay_checkpoints()
+    test_synthetic_replay()
+    test_stream_level3()
+    test_tree_from_snapshot()
+    test_level2_view()
+    test_book_analytics()
+    test_gap_resync()
+    test_stale_snapshot_retry()
+    test_book_manager()
+    test_decode_pipeline()
+    test_decode_pipeline_failures()
+    test_depth_publisher()
+    test_price_places()
+    test_trade_tape()
@@ -2,20 +2,27 @@ import argparse
 import asyncio
 from datetime import datetime, timedelta
 import json
-import pytz
+import os
+import sys
 
 from dateutil.tz import tzlocal
 import requests
 import websockets
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from orderbook.capture import CaptureWriter, read_capture
+from orderbook.timestamps import parse_time_ns
+
 
 ARGS = argparse.ArgumentParser(description='Coinbase Exchange Data Collector')
 ARGS.add_argument('--m', action='store', dest='minutes', default=5, help='Minutes to run')
+ARGS.add_argument('--z', action='store_true', dest='compress', default=False, help='Gzip the capture')
 args = ARGS.parse_args()
 
 minutes = int(args.minutes)
 begin = datetime.now(tzlocal())
 end = begin + timedelta(minutes=minutes)
+capture_path = 'messages.cap.gz' if args.compress else 'messages.cap'
 
 
 def get_beginning_level_3():
@@ -28,49 +35,57 @@ def get_ending_level_3():
     ending_level_3 = requests.get('https://api.pro.coinbase.com/products/BTC-USD/book?level=3').json()
 
 
-@asyncio.coroutine
-def get_websocket_data():
-    coinbase_websocket = yield from websockets.connect("wss://ws-feed.pro.coinbase.com")
-    yield from coinbase_websocket.send('{"type": "subscribe", "product_id": "BTC-USD"}')
-    global messages
-    global latencies
-    messages = []
-    latencies = {}
+async def get_websocket_data(capture):
+    coinbase_websocket = await websockets.connect("wss://ws-feed.pro.coinbase.com")
+    await coinbase_websocket.send('{"type": "subscribe", "product_id": "BTC-USD"}')
     while True:
-        message = yield from coinbase_websocket.recv()
-        message = json.loads(message)
-        messages += [message]
-        latencies[message['time']] = int((datetime.now(tzlocal()) -
-                                              datetime.strptime(message['time'], '%Y-%m-%dT%H:%M:%S.%fZ')
-                                              .replace(tzinfo=pytz.UTC)).microseconds)
+        # frames are written to disk as they arrive, so memory stays flat however long the capture runs
+        capture.write(await coinbase_websocket.recv())
         if datetime.now(tzlocal()) > end:
             return
 
 
+def check_capture(path, first_sequence, last_sequence):
+    """Count the sequence gaps between the two snapshots in one pass over the capture.
+
+    Also returns each frame's exchange to receive latency in microseconds, keyed by its exchange time.
+    """
+    gaps = 0
+    latencies = {}
+    expected = first_sequence + 1
+    for receive_time, frame in read_capture(path):
+        message = json.loads(frame)
+        if 'time' in message:
+            latencies[message['time']] = (receive_time - parse_time_ns(message['time'])) // 1000
+        sequence = message.get('sequence')
+        if sequence is None or not first_sequence < sequence <= last_sequence:
+            continue
+        if sequence != expected:
+            print('sequence gap: expected {0}, got {1}'.format(expected, sequence))
+            gaps += 1
+        expected = sequence + 1
+    if expected != last_sequence + 1:
+        print('capture ends at sequence {0}, before the ending snapshot at {1}'.format(expected - 1, last_sequence))
+        gaps += 1
+    return gaps, latencies
+
+
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     loop.call_later(10, get_beginning_level_3)
     loop.call_later(minutes*60-10, get_ending_level_3)
-    loop.run_until_complete(get_websocket_data())
-    global messages
-    global beginning_level_3
-    global ending_level_3
-    global latencies
+    with CaptureWriter(capture_path, compress=args.compress) as capture:
+        loop.run_until_complete(get_websocket_data(capture))
 
-    first_sequence = beginning_level_3['sequence']
-    last_sequence = ending_level_3['sequence']
-
-    messages = [message for message in messages if first_sequence < message['sequence'] <= last_sequence]
-    messages = sorted(messages, key=lambda k: k['sequence'])
-    for message in messages:
-        assert message['sequence'] == first_sequence + 1
-        first_sequence = message['sequence']
+    gaps, latencies = check_capture(capture_path, beginning_level_3['sequence'], ending_level_3['sequence'])
 
     with open('latencies.json', 'w') as json_file:
         json.dump(latencies, json_file, indent=4, sort_keys=True)
-    with open('messages.json', 'w') as json_file:
-        json.dump(messages, json_file, indent=4, sort_keys=True)
     with open('beginning_level_3.json', 'w') as json_file:
-        json.dump(beginning_level_3, json_file, indent=4, sort_keys=True)
+        json.dump(beginning_level_3, json_file)
     with open('ending_level_3.json', 'w') as json_file:
-        json.dump(ending_level_3, json_file, indent=4, sort_keys=True)
+        json.dump(ending_level_3, json_file)
+
+    # a capture with gaps cannot be replayed against its snapshots, so fail the run rather than keep it quietly
+    if gaps:
+        sys.exit('{0} sequence gaps in {1}'.format(gaps, capture_path))
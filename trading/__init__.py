@@ -1,10 +1,16 @@
 import logging
 from logging.handlers import RotatingFileHandler
 
+from instrumentation.queuelog import BatchingQueueHandler
+
 file_handler = RotatingFileHandler('trading_log.csv', 'a', 10 * 1024 * 1024, 100)
 file_handler.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s, %(message)s'))
 file_handler.setLevel(logging.INFO)
 
+# records are formatted and written by a background thread, off the latency critical paths
+queue_handler = BatchingQueueHandler(file_handler)
+queue_handler.setLevel(logging.INFO)
+
 file_logger = logging.getLogger('trading_file_log')
-file_logger.addHandler(file_handler)
+file_logger.addHandler(queue_handler)
 file_logger.setLevel(logging.INFO)
@@ -1,10 +1,8 @@
-from pprint import pformat
 from decimal import Decimal
 
-import requests
-
 from trading import file_logger
-from trading.exchange import exchange_api_url, exchange_auth
+from trading.exchange import exchange_client
+from trading.responses import ALREADY_DONE, NOT_FOUND, OK, decode_response
 
 
 class OpenOrders(object):
@@ -23,13 +21,13 @@ class OpenOrders(object):
         self.open_ask_cancelled = False
         self.open_ask_rejections = Decimal('0.0')
 
-    def cancel_all(self):
+    async def cancel_all(self):
         if self.open_bid_order_id:
-            self.cancel('bid')
+            await self.cancel('bid')
         if self.open_ask_order_id:
-            self.cancel('ask')
+            await self.cancel('ask')
 
-    def cancel(self, side):
+    async def cancel(self, side):
         if side == 'bid':
             order_id = self.open_bid_order_id
             price = self.open_bid_price
@@ -40,18 +38,18 @@ class OpenOrders(object):
             self.open_ask_cancelled = True
         else:
             return False
-        response = requests.delete(exchange_api_url + 'orders/' + str(order_id), auth=exchange_auth)
-        if response.status_code == 200:
-            file_logger.info('canceled {0} {1} @ {2}'.format(side, order_id, price))
-        elif 'message' in response.json() and response.json()['message'] == 'order not found':
-            file_logger.info('{0} already canceled: {1} @ {2}'.format(side, order_id, price))
-        elif 'message' in response.json() and response.json()['message'] == 'Order already done':
-            file_logger.info('{0} already filled: {1} @ {2}'.format(side, order_id, price))
+        result = decode_response(await exchange_client.delete('orders/' + str(order_id)))
+        if result.outcome == OK:
+            file_logger.info('canceled %s %s @ %s', side, order_id, price)
+        elif result.outcome == NOT_FOUND:
+            file_logger.info('%s already canceled: %s @ %s', side, order_id, price)
+        elif result.outcome == ALREADY_DONE:
+            file_logger.info('%s already filled: %s @ %s', side, order_id, price)
         else:
-            file_logger.error('Unhandled response: {0}'.format((pformat(response.json()))))
+            file_logger.error('Unhandled response: %s', result.body)
 
-    def get_open_orders(self):
-        open_orders = requests.get(exchange_api_url + 'orders', auth=exchange_auth).json()
+    async def get_open_orders(self):
+        open_orders = (await exchange_client.get('orders')).json()
 
         try:
             self.open_bid_order_id = [order['id'] for order in open_orders if order['side'] == 'buy'][0]
@@ -73,8 +71,8 @@ class OpenOrders(object):
             self.open_ask_cancelled = False
             self.open_ask_rejections = Decimal('0.0')
 
-    def get_balances(self):
-        accounts_query = requests.get(exchange_api_url + 'accounts', auth=exchange_auth).json()
+    async def get_balances(self):
+        accounts_query = (await exchange_client.get('accounts')).json()
         for account in accounts_query:
             self.accounts[account['currency']] = account
 
@@ -0,0 +1,60 @@
+from collections import Counter
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'
+INSUFFICIENT_FUNDS = 'insufficient funds'
+EXPIRED = 'expired'
+NOT_FOUND = 'not found'
+ALREADY_DONE = 'already done'
+OK = 'ok'
+UNKNOWN = 'unknown'
+
+MESSAGE_OUTCOMES = {
+    'Insufficient funds': INSUFFICIENT_FUNDS,
+    'request timestamp expired': EXPIRED,
+    'order not found': NOT_FOUND,
+    'Order already done': ALREADY_DONE,
+}
+
+STATUS_OUTCOMES = {
+    'pending': ACCEPTED,
+    'rejected': REJECTED,
+}
+
+# how many responses of each outcome have been decoded since startup
+outcome_counts = Counter()
+
+
+class OrderResult(object):
+    __slots__ = ('outcome', 'order_id', 'status_code', 'body')
+
+    def __init__(self, outcome, order_id, status_code, body):
+        self.outcome = outcome
+        self.order_id = order_id
+        self.status_code = status_code
+        self.body = body
+
+
+def decode_response(response):
+    """Parse an exchange response body once and classify it into an OrderResult."""
+    try:
+        body = json.loads(response.text)
+    except ValueError:
+        body = response.text
+    outcome = None
+    order_id = None
+    if isinstance(body, dict):
+        if 'status' in body:
+            outcome = STATUS_OUTCOMES.get(body['status'])
+            order_id = body.get('id')
+        elif 'message' in body:
+            outcome = MESSAGE_OUTCOMES.get(body['message'])
+    if outcome is None:
+        outcome = OK if response.status_code == 200 else UNKNOWN
+    outcome_counts[outcome] += 1
+    return OrderResult(outcome, order_id, response.status_code, body)
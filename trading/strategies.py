@@ -7,177 +7,190 @@ try:
 except ImportError:
     import json
 
-from pprint import pformat
-import time
+import asyncio
 
-import requests
+from instrumentation.probes import probes
+from trading.exchange import exchange_client
+from trading.responses import ACCEPTED, EXPIRED, INSUFFICIENT_FUNDS, REJECTED, decode_response
 
-from trading.exchange import exchange_api_url, exchange_auth
 
-
-def market_maker_strategy(open_orders, order_book, spreads):
-    time.sleep(10)
-    open_orders.get_open_orders()
-    open_orders.cancel_all()
+async def market_maker_strategy(open_orders, order_book, spreads):
+    await asyncio.sleep(10)
+    await open_orders.get_open_orders()
+    await open_orders.cancel_all()
+    version = None
     while True:
-        time.sleep(0.005)
-        if order_book.asks.price_tree.min_key() - order_book.bids.price_tree.max_key() < 0:
-            file_logger.warn('Negative spread: {0}'.format(
-                order_book.asks.price_tree.min_key() - order_book.bids.price_tree.max_key()))
+        # wake only when the top of book or our own order state has changed
+        version = await order_book.updates.wait(version)
+        best_bid = order_book.best_bid
+        best_ask = order_book.best_ask
+        spread = order_book.spread
+        if spread < 0:
+            file_logger.warning('Negative spread: %s', spread)
             continue
         if not open_orders.open_bid_order_id:
-            open_bid_price = order_book.asks.price_tree.min_key() - spreads.bid_spread - open_orders.open_bid_rejections
+            open_bid_price = best_ask - spreads.bid_spread - open_orders.open_bid_rejections
             if 0.01 * float(open_bid_price) < float(open_orders.accounts['USD']['available']):
                 order = {'size': '0.01',
                          'price': str(open_bid_price),
                          'side': 'buy',
                          'product_id': 'BTC-USD',
                          'post_only': True}
-                response = requests.post(exchange_api_url + 'orders', json=order, auth=exchange_auth)
-                if 'status' in response.json() and response.json()['status'] == 'pending':
-                    open_orders.open_bid_order_id = response.json()['id']
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                result = decode_response(await exchange_client.post('orders', order))
+                if result.outcome == ACCEPTED:
+                    open_orders.open_bid_order_id = result.order_id
                     open_orders.open_bid_price = open_bid_price
                     open_orders.open_bid_rejections = Decimal('0.0')
-                    file_logger.info('new bid @ {0}'.format(open_bid_price))
-                elif 'status' in response.json() and response.json()['status'] == 'rejected':
+                    file_logger.info('new bid @ %s', open_bid_price)
+                elif result.outcome == REJECTED:
                     open_orders.open_bid_order_id = None
                     open_orders.open_bid_price = None
                     open_orders.open_bid_rejections += Decimal('0.04')
-                    file_logger.warn('rejected: new bid @ {0}'.format(open_bid_price))
-                elif 'message' in response.json() and response.json()['message'] == 'Insufficient funds':
+                    file_logger.warning('rejected: new bid @ %s', open_bid_price)
+                elif result.outcome == INSUFFICIENT_FUNDS:
                     open_orders.open_bid_order_id = None
                     open_orders.open_bid_price = None
-                    file_logger.warn('Insufficient USD')
+                    file_logger.warning('Insufficient USD')
                 else:
-                    file_logger.error('Unhandled response: {0}'.format(pformat(response.json())))
+                    file_logger.error('Unhandled response: %s', result.body)
                 continue
 
         if not open_orders.open_ask_order_id:
-            open_ask_price = order_book.bids.price_tree.max_key() + spreads.ask_spread + open_orders.open_ask_rejections
+            open_ask_price = best_bid + spreads.ask_spread + open_orders.open_ask_rejections
             if 0.01 < float(open_orders.accounts['BTC']['available']):
                 order = {'size': '0.01',
                          'price': str(open_ask_price),
                          'side': 'sell',
                          'product_id': 'BTC-USD',
                          'post_only': True}
-                response = requests.post(exchange_api_url + 'orders', json=order, auth=exchange_auth)
-                if 'status' in response.json() and response.json()['status'] == 'pending':
-                    open_orders.open_ask_order_id = response.json()['id']
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                result = decode_response(await exchange_client.post('orders', order))
+                if result.outcome == ACCEPTED:
+                    open_orders.open_ask_order_id = result.order_id
                     open_orders.open_ask_price = open_ask_price
-                    file_logger.info('new ask @ {0}'.format(open_ask_price))
+                    file_logger.info('new ask @ %s', open_ask_price)
                     open_orders.open_ask_rejections = Decimal('0.0')
-                elif 'status' in response.json() and response.json()['status'] == 'rejected':
+                elif result.outcome == REJECTED:
                     open_orders.open_ask_order_id = None
                     open_orders.open_ask_price = None
                     open_orders.open_ask_rejections += Decimal('0.04')
-                    file_logger.warn('rejected: new ask @ {0}'.format(open_ask_price))
-                elif 'message' in response.json() and response.json()['message'] == 'Insufficient funds':
+                    file_logger.warning('rejected: new ask @ %s', open_ask_price)
+                elif result.outcome == INSUFFICIENT_FUNDS:
                     open_orders.open_ask_order_id = None
                     open_orders.open_ask_price = None
-                    file_logger.warn('Insufficient BTC')
+                    file_logger.warning('Insufficient BTC')
                 else:
-                    file_logger.error('Unhandled response: {0}'.format(pformat(response.json())))
+                    file_logger.error('Unhandled response: %s', result.body)
                 continue
 
         if open_orders.open_bid_order_id and not open_orders.open_bid_cancelled:
-            bid_too_far_out = open_orders.open_bid_price < (order_book.asks.price_tree.min_key()
+            bid_too_far_out = open_orders.open_bid_price < (best_ask
                                                             - spreads.bid_too_far_adjustment_spread)
-            bid_too_close = open_orders.open_bid_price > (order_book.bids.price_tree.max_key()
+            bid_too_close = open_orders.open_bid_price > (best_bid
                                                           - spreads.bid_too_close_adjustment_spread)
             cancel_bid = bid_too_far_out or bid_too_close
             if cancel_bid:
                 if bid_too_far_out:
-                    file_logger.info('CANCEL: open bid {0} too far from best ask: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open bid %s too far from best ask: %s spread: %s',
                         open_orders.open_bid_price,
-                        order_book.asks.price_tree.min_key(),
-                        open_orders.open_bid_price - order_book.asks.price_tree.min_key()))
+                        best_ask,
+                        open_orders.open_bid_price - best_ask)
                 if bid_too_close:
-                    file_logger.info('CANCEL: open bid {0} too close to best bid: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open bid %s too close to best bid: %s spread: %s',
                         open_orders.open_bid_price,
-                        order_book.bids.price_tree.max_key(),
-                        open_orders.open_bid_price - order_book.bids.price_tree.max_key()))
-                open_orders.cancel('bid')
+                        best_bid,
+                        open_orders.open_bid_price - best_bid)
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                await open_orders.cancel('bid')
                 continue
 
         if open_orders.open_ask_order_id and not open_orders.open_ask_cancelled:
-            ask_too_far_out = open_orders.open_ask_price > (order_book.bids.price_tree.max_key() +
+            ask_too_far_out = open_orders.open_ask_price > (best_bid +
                                                             spreads.ask_too_far_adjustment_spread)
 
-            ask_too_close = open_orders.open_ask_price < (order_book.asks.price_tree.min_key() -
+            ask_too_close = open_orders.open_ask_price < (best_ask -
                                                           spreads.ask_too_close_adjustment_spread)
 
             cancel_ask = ask_too_far_out or ask_too_close
 
             if cancel_ask:
                 if ask_too_far_out:
-                    file_logger.info('CANCEL: open ask {0} too far from best bid: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open ask %s too far from best bid: %s spread: %s',
                         open_orders.open_ask_price,
-                        order_book.bids.price_tree.max_key(),
-                        open_orders.open_ask_price - order_book.bids.price_tree.max_key()))
+                        best_bid,
+                        open_orders.open_ask_price - best_bid)
                 if ask_too_close:
-                    file_logger.info('CANCEL: open ask {0} too close to best ask: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open ask %s too close to best ask: %s spread: %s',
                         open_orders.open_ask_price,
-                        order_book.asks.price_tree.min_key(),
-                        open_orders.open_ask_price - order_book.asks.price_tree.min_key()))
-                open_orders.cancel('ask')
+                        best_ask,
+                        open_orders.open_ask_price - best_ask)
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                await open_orders.cancel('ask')
                 continue
 
 
-def buyer_strategy(order_book, open_orders, spreads):
-    time.sleep(10)
+async def buyer_strategy(order_book, open_orders, spreads):
+    await asyncio.sleep(10)
+    version = None
+    checked_version = None
     while True:
-        time.sleep(0.001)
+        version = await order_book.updates.wait(version)
+        best_bid = order_book.best_bid
         if not open_orders.open_bid_order_id:
-            open_bid_price = order_book.bids.price_tree.max_key() - spreads.bid_spread
+            checked_version = None
+            open_bid_price = best_bid - spreads.bid_spread
             if 0.01 * float(open_bid_price) < float(open_orders.accounts['USD']['available']):
                 order = {'size': '0.01',
                          'price': str(open_bid_price),
                          'side': 'buy',
                          'product_id': 'BTC-USD',
                          'post_only': True}
-                response = requests.post(exchange_api_url + 'orders', json=order, auth=exchange_auth)
-                try:
-                    response = response.json()
-                except ValueError:
-                    file_logger.error('Unhandled response: {0}'.format(pformat(response)))
-                if 'status' in response and response['status'] == 'pending':
-                    open_orders.open_bid_order_id = response['id']
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                result = decode_response(await exchange_client.post('orders', order))
+                if result.outcome == ACCEPTED:
+                    open_orders.open_bid_order_id = result.order_id
                     open_orders.open_bid_price = open_bid_price
                     open_orders.open_bid_rejections = Decimal('0.0')
-                    file_logger.info('new bid @ {0}'.format(open_bid_price))
-                elif 'status' in response and response['status'] == 'rejected':
+                    file_logger.info('new bid @ %s', open_bid_price)
+                elif result.outcome == REJECTED:
                     open_orders.open_bid_order_id = None
                     open_orders.open_bid_price = None
                     open_orders.open_bid_rejections += Decimal('0.04')
-                    file_logger.warn('rejected: new bid @ {0}'.format(open_bid_price))
-                elif 'message' in response and response['message'] == 'Insufficient funds':
+                    file_logger.warning('rejected: new bid @ %s', open_bid_price)
+                elif result.outcome == INSUFFICIENT_FUNDS:
                     open_orders.open_bid_order_id = None
                     open_orders.open_bid_price = None
-                    file_logger.warn('Insufficient USD')
-                elif 'message' in response and response['message'] == 'request timestamp expired':
+                    file_logger.warning('Insufficient USD')
+                elif result.outcome == EXPIRED:
                     open_orders.open_bid_order_id = None
                     open_orders.open_bid_price = None
-                    file_logger.warn('Request timestamp expired')
+                    file_logger.warning('Request timestamp expired')
                 else:
-                    file_logger.error('Unhandled response: {0}'.format(pformat(response)))
+                    file_logger.error('Unhandled response: %s', result.body)
                 continue
 
         if open_orders.open_bid_order_id and not open_orders.open_bid_cancelled:
-            bid_too_far_out = open_orders.open_bid_price < (order_book.bids.price_tree.max_key()
+            # the top of book has not moved since this bid was last checked
+            if checked_version == version:
+                continue
+            checked_version = version
+            bid_too_far_out = open_orders.open_bid_price < (best_bid
                                                             - spreads.bid_too_far_adjustment_spread)
-            bid_too_close = open_orders.open_bid_price > (order_book.bids.price_tree.max_key()
+            bid_too_close = open_orders.open_bid_price > (best_bid
                                                           - spreads.bid_too_close_adjustment_spread)
             cancel_bid = bid_too_far_out or bid_too_close
             if cancel_bid:
                 if bid_too_far_out:
-                    file_logger.info('CANCEL: open bid {0} too far from best bid: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open bid %s too far from best bid: %s spread: %s',
                         open_orders.open_bid_price,
-                        order_book.bids.price_tree.max_key(),
-                        order_book.bids.price_tree.max_key() - open_orders.open_bid_price))
+                        best_bid,
+                        best_bid - open_orders.open_bid_price)
                 if bid_too_close:
-                    file_logger.info('CANCEL: open bid {0} too close to best bid: {1} spread: {2}'.format(
+                    file_logger.info('CANCEL: open bid %s too close to best bid: %s spread: %s',
                         open_orders.open_bid_price,
-                        order_book.bids.price_tree.max_key(),
-                        order_book.bids.price_tree.max_key() - open_orders.open_bid_price))
-                open_orders.cancel('bid')
+                        best_bid,
+                        best_bid - open_orders.open_bid_price)
+                probes.since('strategy_reaction', order_book.updates.notified_at)
+                await open_orders.cancel('bid')
                 continue
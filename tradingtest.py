@@ -0,0 +1,174 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from aiohttp import web
+
+# the exchange module reads the API credentials from coinbase_config at import time
+if 'coinbase_config' not in sys.modules:
+    try:
+        import coinbase_config
+    except ImportError:
+        coinbase_config = types.ModuleType('coinbase_config')
+        coinbase_config.COINBASE_EXCHANGE_API_KEY = 'key'
+        coinbase_config.COINBASE_EXCHANGE_API_SECRET = base64.b64encode(b'secret').decode('utf-8')
+        coinbase_config.COINBASE_EXCHANGE_API_PASSPHRASE = 'passphrase'
+        sys.modules['coinbase_config'] = coinbase_config
+
+from trading.exchange import CoinbaseExchangeAuthentication, ExchangeClient, ExchangeResponse
+from trading import responses
+
+SECRET = b'stub secret'
+
+
+def self_signed_certificate(directory):
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1',
+                           '-keyout', key_file, '-out', cert_file],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+class StubExchange(object):
+    """HTTPS stub of the order entry endpoints that checks signatures and counts TCP connections."""
+
+    def __init__(self, cert_file, key_file):
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl_context.load_cert_chain(cert_file, key_file)
+        self.connections = set()
+        self.orders = 0
+        self.runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/time', self.time)
+        app.router.add_post('/orders', self.post_order)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0, ssl_context=self.ssl_context)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def time(self, request):
+        self.connections.add(request.transport.get_extra_info('peername'))
+        return web.json_response({'epoch': time.time()})
+
+    async def post_order(self, request):
+        self.connections.add(request.transport.get_extra_info('peername'))
+        body = await request.text()
+        message = request.headers['CB-ACCESS-TIMESTAMP'] + request.method + request.path + body
+        signature = base64.b64encode(hmac.new(SECRET, message.encode('utf-8'), hashlib.sha256).digest())
+        if signature.decode('utf-8') != request.headers['CB-ACCESS-SIGN']:
+            return web.json_response({'message': 'invalid signature'}, status=400)
+        self.orders += 1
+        return web.json_response({'id': str(self.orders), 'status': 'pending'})
+
+
+def client_for(stub, cert_file, pool_size=4):
+    auth = CoinbaseExchangeAuthentication('key', base64.b64encode(SECRET).decode('utf-8'), 'passphrase')
+    return ExchangeClient('https://127.0.0.1:{0}/'.format(stub.port), auth, pool_size=pool_size,
+                          ssl=ssl.create_default_context(cafile=cert_file))
+
+
+async def place_orders(client, count):
+    latencies = []
+    order = {'size': '0.01', 'price': '100.00', 'side': 'buy', 'product_id': 'BTC-USD', 'post_only': True}
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await client.post('orders', order)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.text
+        assert response.json()['status'] == 'pending'
+    return sorted(latencies)
+
+
+def test_connection_pool():
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file = self_signed_certificate(directory)
+
+        async def run():
+            stub = StubExchange(cert_file, key_file)
+            await stub.start()
+            client = client_for(stub, cert_file, pool_size=2)
+            try:
+                await client.warm_up()
+                warm_connections = len(stub.connections)
+                await place_orders(client, 20)
+            finally:
+                await client.close()
+                await stub.stop()
+            assert 1 <= warm_connections <= 2
+            assert stub.orders == 20
+            # every signed order reused a pre-warmed connection
+            assert len(stub.connections) == warm_connections
+
+        asyncio.run(run())
+
+
+def test_decode_response():
+    cases = [
+        (200, '{"id": "abc", "status": "pending"}', responses.ACCEPTED),
+        (200, '{"id": "abc", "status": "rejected"}', responses.REJECTED),
+        (400, '{"message": "Insufficient funds"}', responses.INSUFFICIENT_FUNDS),
+        (400, '{"message": "request timestamp expired"}', responses.EXPIRED),
+        (404, '{"message": "order not found"}', responses.NOT_FOUND),
+        (400, '{"message": "Order already done"}', responses.ALREADY_DONE),
+        (200, '["abc"]', responses.OK),
+        (502, '<html>Bad Gateway</html>', responses.UNKNOWN),
+    ]
+    before = responses.outcome_counts.copy()
+    for status_code, text, outcome in cases:
+        result = responses.decode_response(ExchangeResponse(status_code, text))
+        assert result.outcome == outcome
+    assert responses.decode_response(ExchangeResponse(200, cases[0][1])).order_id == 'abc'
+    assert responses.outcome_counts[responses.ACCEPTED] == before[responses.ACCEPTED] + 2
+
+
+def benchmark_order_placement(count=200):
+    with tempfile.TemporaryDirectory() as directory:
+        cert_file, key_file = self_signed_certificate(directory)
+
+        async def run():
+            stub = StubExchange(cert_file, key_file)
+            await stub.start()
+            results = {}
+            try:
+                # a fresh session per order pays the TCP and TLS handshake every time
+                cold = []
+                for _ in range(count):
+                    client = client_for(stub, cert_file)
+                    cold.extend(await place_orders(client, 1))
+                    await client.close()
+                results['new connection'] = sorted(cold)
+
+                client = client_for(stub, cert_file)
+                await client.warm_up()
+                results['pooled'] = await place_orders(client, count)
+                await client.close()
+            finally:
+                await stub.stop()
+            for name, latencies in results.items():
+                print('{0}: median {1:.3f} ms, p99 {2:.3f} ms'.format(
+                    name, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test_connection_pool()
+    test_decode_response()
+    benchmark_order_placement()